@@ -17,6 +17,43 @@ def use_api(string):
     embedding = response['data'][0]['embedding']
     return embedding
 
+def use_api_batch(strings):
+    """Uses OpenAI API to retrieve ada-002 text embeddings of a list of strings, in one request.
+
+    Returns the embeddings in the same order as the strings."""
+
+    print(col('cy', f'using api for {len(strings)} strings'))
+    for string in strings:
+        if type(string) is not str:
+            exit('use_api_batch can only take a list of strings')
+    response = openai.Embedding.create(input=strings, model='text-embedding-ada-002')
+    data = sorted(response['data'], key=lambda item: item['index'])
+    return [item['embedding'] for item in data]
+
+def estimate_tokens(string):
+    # roughly 4 characters per token for english text, good enough for sizing batches
+    return len(string) // 4 + 1
+
+def make_batches(strings, max_tokens=8000, max_size=2048):
+    """Splits strings into batches of at most max_size strings and about max_tokens tokens.
+
+    A string that is bigger than max_tokens on its own gets a batch to itself."""
+
+    batches = []
+    current = []
+    current_tokens = 0
+    for string in strings:
+        tokens = estimate_tokens(string)
+        if current != [] and (current_tokens + tokens > max_tokens or len(current) >= max_size):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(string)
+        current_tokens += tokens
+    if current != []:
+        batches.append(current)
+    return batches
+
 class DataHandler:
     """Indexer maps a string to the path where the embedding of that string is stored."""
 
@@ -168,10 +205,24 @@ class DataHandler:
             self._store_embedding(string, emb, meta)
             return emb
 
-    def embed_list(self, lst, meta_lst):
+    def embed_list(self, lst, meta_lst, max_batch_tokens=8000):
+        """Embeds and stores every string in lst that isn't stored yet, with the matching list of tags from meta_lst.
+
+        Strings are sent to the api in batches of about max_batch_tokens tokens, one request per batch."""
+
+        uncached = {}  # string -> meta, for strings not in the database. a dict drops duplicates
         for item, meta in zip(lst, meta_lst):
+            assert type(item) is str
             assert type(meta) is list
-            self.get_embedding(item, meta)
+            if item not in self.string_to_index and item not in uncached:
+                uncached[item] = meta
+
+        batches = make_batches(list(uncached.keys()), max_batch_tokens)
+        print(f'embedding {len(uncached)} new strings of {len(lst)} in {len(batches)} requests')
+        for batch in batches:
+            embs = use_api_batch(batch)
+            for item, emb in zip(batch, embs):
+                self._store_embedding(item, emb, uncached[item])
     
     def delete_embedding(self, string):
         if string in self.string_to_index:
@@ -540,6 +540,8 @@ def main():
                 contents = event.widget.get(1.0, 'end')[:-1]
                 strings = contents.split('\n=====\n')
 
+                texts = []
+                tag_lists = []
                 for string in strings:
                     # use !!! lines as metadata tags
                     lines = []
@@ -549,10 +551,9 @@ def main():
                             tags.append(line[3:])
                         else:
                             lines.append(line)
-                    data_handler.get_embedding(  # will retrieve the embedding and add it to the database
-                        '\n'.join(lines),
-                        tags,
-                    )
+                    texts.append('\n'.join(lines))
+                    tag_lists.append(tags)
+                data_handler.embed_list(texts, tag_lists)  # will retrieve the embeddings in batches and add them to the database
 
                 print(col('gr', 'done embedding strings'))
 
@@ -0,0 +1,295 @@
+"""
+Benchmarks of embeddings_module.DataHandler on synthetic corpora, without the network.
+
+Every corpus is random unit vectors with random tag sets, stored in its own temporary folder.
+Vectors come from RandomProvider instead of the api, so nothing is sent anywhere. For each corpus size it measures:
+- insert throughput of _store_embedding (one row per call) and of _store_embeddings (batches)
+- startup time of DataHandler() on the stored corpus, in RAM and memory mapped
+- search latency for several n and tag filter selectivities
+- memory: traced python and numpy allocations of startup and search, and the resident size after every phase.
+  only one DataHandler is open at a time, so the resident size is the store's, not the harness'
+
+The results go to a json report. compare_reports() prints the change between two reports, e.g. before and after a commit.
+
+    python benchmark.py                                 # 1k, 10k, 100k and 1M rows of 1536 dimensions
+    python benchmark.py --sizes 1000 10000 --dim 256
+    python benchmark.py --compare old_report.json benchmark_report.json
+"""
+
+import os, io, sys, gc, time, shutil, tempfile, tracemalloc, contextlib, subprocess, platform, argparse, hashlib
+import numpy as np
+
+from overall_imports import col, make_json, open_json
+import embeddings_module
+
+try:
+    import resource  # not on windows
+except ImportError:
+    resource = None
+
+# tags that a row has with this probability, so filtering on them keeps about that share of the rows
+selectivity_tags = {'sel-0.5': 0.5, 'sel-0.1': 0.1, 'sel-0.01': 0.01}
+
+class RandomProvider:
+    """Stands in for the embeddings api. Every string gets a random unit vector, seeded by the string,
+    so the same string always gets the same vector."""
+
+    remote = False
+
+    def __init__(self, dim=1536):
+        self.dim = dim
+        self.name = f'random:{dim}'
+
+    def embed(self, strings):
+        embeddings = []
+        for string in strings:
+            seed = int.from_bytes(hashlib.blake2b(string.encode('utf-8'), digest_size=8).digest(), 'little')
+            embeddings.append(random_unit_vectors(np.random.default_rng(seed), 1, self.dim)[0].tolist())
+        return embeddings
+
+def random_unit_vectors(rng, n, dim):
+    vectors = rng.standard_normal((n, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+def random_tags(rng, n, n_tags=100):
+    """n random tag lists: 1 to 3 of `n_tags` common tags, and each of the selectivity tags with its probability."""
+
+    counts = rng.integers(1, 4, n)
+    common = rng.integers(0, n_tags, (n, 3))
+    has_tag = {tag: rng.random(n) < p for tag, p in selectivity_tags.items()}
+    metas = []
+    for row in range(n):
+        meta = [f'tag-{i}' for i in dict.fromkeys(common[row, :counts[row]].tolist())]
+        meta += [tag for tag in selectivity_tags if has_tag[tag][row]]
+        metas.append(meta)
+    return metas
+
+def percentile_ms(seconds, q):
+    return round(1000 * float(np.percentile(seconds, q)), 3)
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on linux and bytes on macos
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1)
+
+def rss_mb():
+    # resident size right now, linux only. the peak can't go down again, so it can't tell the phases apart
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20, 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+@contextlib.contextmanager
+def quiet():
+    # DataHandler prints a few lines per search, which would be most of what is measured
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+@contextlib.contextmanager
+def traced(result, key):
+    # tracemalloc slows python down a lot, so it is only on in runs that aren't timed
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        result[key] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        tracemalloc.stop()
+
+def close(data_handler):
+    if data_handler.search_pool is not None:
+        data_handler.search_pool.shutdown()
+    data_handler.metadata.close()
+
+def collect():
+    # a DataHandler is a reference cycle (its SearchBatcher points back to it), so dropping the last
+    # reference doesn't free its arrays, only the cycle collector does
+    gc.collect()
+
+def bench_inserts(data_handler, rng, n_rows, dim, single_rows=1000, batch_rows=10000):
+    """Stores n_rows rows. The first single_rows go through _store_embedding, the rest in batches through _store_embeddings."""
+
+    result = {}
+    n_single = min(n_rows, single_rows)
+    vectors = random_unit_vectors(rng, n_single, dim)
+    metas = random_tags(rng, n_single)
+    t0 = time.perf_counter()
+    with quiet():
+        for row in range(n_single):
+            data_handler._store_embedding(f'row {row}', vectors[row].tolist(), metas[row])
+    seconds = time.perf_counter() - t0
+    result['single rows'] = n_single
+    result['single rows per second'] = round(n_single / seconds, 1)
+
+    if n_rows > n_single:
+        seconds = 0.0
+        for start in range(n_single, n_rows, batch_rows):
+            stop = min(n_rows, start + batch_rows)
+            vectors = random_unit_vectors(rng, stop - start, dim)
+            metas = random_tags(rng, stop - start)
+            t0 = time.perf_counter()
+            with quiet():
+                data_handler._store_embeddings([f'row {row}' for row in range(start, stop)], vectors, metas)
+            seconds += time.perf_counter() - t0
+        result['batch rows'] = n_rows - n_single
+        result['batch rows per second'] = round((n_rows - n_single) / seconds, 1)
+    return result
+
+def bench_startup(provider, memory):
+    """Seconds to open the corpus in the current folder, memory mapped and in RAM. Returns (result, handler in RAM).
+
+    Every handler is closed and collected before the next one is opened, except the last one, which is returned."""
+
+    result = {}
+    for memory_mapped in [True, False]:
+        name = 'memory mapped' if memory_mapped else 'in RAM'
+        with quiet(), traced(memory, f'startup {name} mb'):
+            close(embeddings_module.DataHandler(memory_mapped=memory_mapped, provider=provider))
+        collect()
+        t0 = time.perf_counter()
+        with quiet():
+            data_handler = embeddings_module.DataHandler(memory_mapped=memory_mapped, provider=provider)
+        result[f'{name} seconds'] = round(time.perf_counter() - t0, 4)
+        memory[f'rss after startup {name} mb'] = rss_mb()
+        if memory_mapped:
+            close(data_handler)
+            del data_handler
+            collect()
+    return result, data_handler
+
+def bench_search(data_handler, rng, dim, ns, n_queries, memory):
+    """Latency of data_handler.search for every n and tag filter, with n_queries new random queries each."""
+
+    filters = [[]] + [[tag] for tag in selectivity_tags]
+    result = []
+    for has in filters:
+        selectivity = float(data_handler._filter_mask(has, []).mean())
+        for n in ns:
+            queries = random_unit_vectors(rng, n_queries, dim)
+            seconds = []
+            with quiet():
+                for query in queries:
+                    t0 = time.perf_counter()
+                    data_handler.search(query, {'n': n, 'has': has, 'hasno': []})
+                    seconds.append(time.perf_counter() - t0)
+            result.append({
+                'n': n,
+                'has': has,
+                'selectivity': round(selectivity, 4),
+                'median ms': percentile_ms(seconds, 50),
+                'p95 ms': percentile_ms(seconds, 95),
+            })
+
+    with quiet(), traced(memory, 'search mb'):
+        data_handler.search(random_unit_vectors(rng, 1, dim)[0], {'n': max(ns), 'has': [], 'hasno': []})
+    memory['rss after search mb'] = rss_mb()
+    return result
+
+def bench_corpus(n_rows, dim=1536, ns=(1, 10, 100), n_queries=20, seed=0):
+    """Builds a corpus of n_rows rows in a temporary folder, runs every benchmark on it, then deletes the folder."""
+
+    rng = np.random.default_rng(seed)
+    provider = RandomProvider(dim)
+    folder = tempfile.mkdtemp(prefix='embeddings_benchmark_')
+    cwd = os.getcwd()
+    memory = {}
+    # DataHandler keeps its files in the working directory
+    os.chdir(folder)
+    try:
+        with quiet():
+            data_handler = embeddings_module.DataHandler(provider=provider)
+        inserts = bench_inserts(data_handler, rng, n_rows, dim)
+        memory['rss after inserts mb'] = rss_mb()
+        close(data_handler)
+        del data_handler
+        collect()
+        startup, data_handler = bench_startup(provider, memory)
+        search = bench_search(data_handler, rng, dim, ns, n_queries, memory)
+        close(data_handler)
+        del data_handler
+        collect()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+    memory['peak rss so far mb'] = peak_rss_mb()
+    return {'rows': n_rows, 'insert': inserts, 'startup': startup, 'search': search, 'memory': memory}
+
+def git_commit():
+    try:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=folder, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(sizes=(1000, 10000, 100000, 1000000), dim=1536, ns=(1, 10, 100), n_queries=20, report_path='benchmark_report.json'):
+    """Benchmarks a corpus of every size, smallest first, and writes the json report to report_path."""
+
+    report = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpus': os.cpu_count(),
+        'dim': dim,
+        'queries per setting': n_queries,
+        'corpora': [],
+    }
+    for n_rows in sorted(sizes):
+        print(col('cy', f'benchmarking {n_rows} rows of {dim} dimensions'))
+        t0 = time.time()
+        corpus = bench_corpus(n_rows, dim, ns, n_queries)
+        report['corpora'].append(corpus)
+        make_json(report, report_path)
+        print(f'    inserts: {corpus["insert"]}')
+        print(f'    startup: {corpus["startup"]}')
+        print(f'    search, no filter: ' + ', '.join(f'n={s["n"]} {s["median ms"]} ms' for s in corpus['search'] if s['has'] == []))
+        print(f'    memory: {corpus["memory"]}')
+        print(f'    {time.time()-t0:.1f} seconds')
+    print(col('gr', f'report written to {report_path}'))
+    return report
+
+def flatten(report):
+    # {(rows, metric name): value} for every number in a report, search settings included in the name
+    metrics = {}
+    for corpus in report['corpora']:
+        for section in ['insert', 'startup', 'memory']:
+            for name, value in corpus[section].items():
+                if type(value) in [int, float]:
+                    metrics[(corpus['rows'], f'{section} {name}')] = value
+        for s in corpus['search']:
+            for name in ['median ms', 'p95 ms']:
+                metrics[(corpus['rows'], f'search n={s["n"]} has={s["has"]} {name}')] = s[name]
+    return metrics
+
+def compare_reports(old_path, new_path):
+    """Prints every metric that is in both reports, with the ratio new/old."""
+
+    old = open_json(old_path)
+    new = open_json(new_path)
+    print(f'{old_path} (commit {old["commit"]}) -> {new_path} (commit {new["commit"]})')
+    old_metrics = flatten(old)
+    new_metrics = flatten(new)
+    for key in new_metrics:
+        if key not in old_metrics or old_metrics[key] == 0:
+            continue
+        rows, name = key
+        ratio = new_metrics[key] / old_metrics[key]
+        print(f'{rows:>8} rows  {name:<50} {old_metrics[key]:>12} -> {new_metrics[key]:>12}  x{ratio:.2f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks DataHandler on synthetic corpora, offline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--ns', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--report', default='benchmark_report.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare_reports(*args.compare)
+    else:
+        run_benchmarks(args.sizes, args.dim, args.ns, args.queries, os.path.abspath(args.report))
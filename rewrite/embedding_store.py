@@ -0,0 +1,468 @@
+"""
+On-disk storage for embedding vectors, used by embeddings_module.DataHandler
+
+- EmbeddingSegment:
+    append-only file of fixed-width float32 rows. storing a vector is one append and one fsync,
+    instead of one json file per vector plus a rebuild of the whole array.
+- RowBuffer:
+    2d array in RAM that can be appended to in amortized O(1).
+- RowBitmap:
+    boolean column over the rows in RAM, that can be appended to in amortized O(1). used for tombstones.
+- CompactCopy:
+    float16 or int8 copy of a segment, kept in RAM for scoring, with its own segment files on disk.
+- TextSegment:
+    append-only file of variable-length utf-8 records, for the text and tags of each row.
+- QueryCache:
+    bounded least-recently-used cache of query embeddings on disk, apart from the stored rows.
+"""
+
+import os, struct, json
+from collections import OrderedDict
+import numpy as np
+
+class EmbeddingSegment:
+    """Append-only file of fixed-width rows, float32 unless another dtype is given.
+
+    Layout:
+    --
+    header -- magic (8 bytes), format version, dimension, row offset, dtype code  (uint32's, zero-padded to `row_offset` bytes)
+    rows -- row n starts at byte `row_offset + n*row_bytes`, and is `dim` values of the segment's dtype
+
+    The number of rows is derived from the file size, so a row that was only half-written (crash, power loss)
+    is cut off the next time the file is opened.
+
+    External methods:
+    --
+    append(vector) -- append one vector, returns its row id
+    append_many(vectors) -- append a 2d array of vectors, returns the row id of the first one
+    read_all() -- returns all rows as a (rows, dim) float32 array
+    memmap() -- returns all rows as a read-only memory map
+    write_rows(rows, vectors) -- overwrite existing rows in place
+    truncate(n_rows) -- drop every row from n_rows onwards
+    """
+
+    magic = b'EMBSEG\x00\x00'
+    version = 1
+    row_offset = 64
+    header_format = '<8sIIII'
+    dtype_codes = {0: np.dtype('<f4'), 1: np.dtype('<f2'), 2: np.dtype('i1'), 3: np.dtype('<i4'), 4: np.dtype('u1')}
+
+    def __init__(self, path, dtype='<f4'):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in self.dtype_codes.values()
+        self.dim = None
+        self.n_rows = 0
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._read_header()
+            size = os.path.getsize(path)
+            self.n_rows = (size - self.row_offset) // self.row_bytes
+
+            # cut off a partially written last row, so the next append starts at a row boundary
+            expected = self.row_offset + self.n_rows*self.row_bytes
+            if size != expected:
+                print(f'{path}: dropping {size-expected} bytes of a partially written row')
+                with open(path, 'r+b') as f:
+                    f.truncate(expected)
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def row_bytes(self):
+        return self.dim * self.dtype.itemsize
+
+    def _read_header(self):
+        with open(self.path, 'rb') as f:
+            raw = f.read(struct.calcsize(self.header_format))
+        magic, version, dim, row_offset, dtype_code = struct.unpack(self.header_format, raw)
+        if magic != self.magic:
+            raise ValueError(f'{self.path} is not an embedding segment file')
+        if version != self.version:
+            raise ValueError(f'{self.path} has format version {version}, expected {self.version}')
+        if self.dtype_codes.get(dtype_code) != self.dtype:
+            raise ValueError(f'{self.path} has dtype code {dtype_code}, expected {self.dtype}')
+        assert row_offset == self.row_offset
+        self.dim = dim
+
+    def _write_header(self, dim):
+        dtype_code = {v:k for k,v in self.dtype_codes.items()}[self.dtype]
+        header = struct.pack(self.header_format, self.magic, self.version, dim, self.row_offset, dtype_code)
+        header = header.ljust(self.row_offset, b'\x00')
+        with open(self.path, 'wb') as f:
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+        self.dim = dim
+
+    def append(self, vector):
+        return self.append_many(np.asarray(vector).reshape(1, -1))
+
+    def append_many(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        assert vectors.ndim == 2
+
+        if self.dim is None:
+            self._write_header(vectors.shape[1])
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f'vector has dimension {vectors.shape[1]}, segment has {self.dim}')
+
+        first_row = self.n_rows
+        with open(self.path, 'ab') as f:
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.n_rows += len(vectors)
+        return first_row
+
+    def read_all(self):
+        if self.dim is None:
+            return np.zeros((0, 0), dtype=self.dtype)
+        with open(self.path, 'rb') as f:
+            f.seek(self.row_offset)
+            arr = np.fromfile(f, dtype=self.dtype, count=self.n_rows*self.dim)
+        return arr.reshape(self.n_rows, self.dim)
+
+    def memmap(self):
+        """Returns the rows as a read-only memory map, pages are only read from disk when they are used."""
+        if self.dim is None or self.n_rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.row_offset, shape=(self.n_rows, self.dim))
+
+    def write_rows(self, rows, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype).reshape(len(rows), -1)
+        assert vectors.shape[1] == self.dim
+        with open(self.path, 'r+b') as f:
+            for row, vector in zip(rows, vectors):
+                assert 0 <= row < self.n_rows
+                f.seek(self.row_offset + row*self.row_bytes)
+                f.write(vector.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def truncate(self, n_rows):
+        assert 0 <= n_rows <= self.n_rows
+        if self.dim is None:
+            return
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.row_offset + n_rows*self.row_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        self.n_rows = n_rows
+
+
+class RowBuffer:
+    """2d array that can be appended to in amortized O(1), by doubling its capacity when it is full.
+
+    `array` is a view of the filled rows, so it has to be fetched again after every append."""
+
+    def __init__(self, rows):
+        self._buffer = rows
+        self.n_rows = len(rows)
+
+    @property
+    def array(self):
+        return self._buffer[:self.n_rows]
+
+    def append(self, row):
+        row = np.asarray(row, dtype=self._buffer.dtype).reshape(-1)
+        self.extend(row.reshape(1, -1))
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self._buffer.dtype)
+        if self.n_rows + len(rows) > len(self._buffer):
+            capacity = max(16, 2*len(self._buffer), self.n_rows + len(rows))
+            new_buffer = np.empty((capacity, rows.shape[1]), dtype=self._buffer.dtype)
+            if self.n_rows > 0:
+                new_buffer[:self.n_rows] = self.array
+            self._buffer = new_buffer
+        self._buffer[self.n_rows:self.n_rows+len(rows)] = rows
+        self.n_rows += len(rows)
+
+
+class RowBitmap:
+    """Boolean column over the rows, False for new rows. Grows like RowBuffer.
+
+    `array` is a view of the filled rows, so it has to be fetched again after every append."""
+
+    def __init__(self, n_rows):
+        self._buffer = np.zeros(max(16, n_rows), dtype=bool)
+        self.n_rows = n_rows
+        self.n_set = 0
+
+    @property
+    def array(self):
+        return self._buffer[:self.n_rows]
+
+    def append(self):
+        if self.n_rows >= len(self._buffer):
+            grown = np.zeros(2*len(self._buffer), dtype=bool)
+            grown[:self.n_rows] = self.array
+            self._buffer = grown
+        self.n_rows += 1
+
+    def set(self, rows):
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        self.n_set += int(np.count_nonzero(~self._buffer[rows]))
+        self._buffer[rows] = True
+
+
+def quantize(vectors, precision):
+    """Returns (compact rows, scales) for a 2d float array.
+
+    float16 -- rows are just cast, scales is None
+    int8 -- every row is divided by its own scale (max abs value / 127) and rounded, so row ~= compact row * scale
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if precision == 'float16':
+        return vectors.astype(np.float16), None
+    elif precision == 'int8':
+        scales = np.abs(vectors).max(axis=1, initial=0) / 127
+        scales[scales == 0] = 1
+        compact = np.round(vectors / scales[:, None]).astype(np.int8)
+        return compact, scales.astype(np.float32).reshape(-1, 1)
+    else:
+        raise ValueError(f'unknown precision {precision}, must be float16 or int8')
+
+
+class CompactCopy:
+    """float16 or int8 copy of a float32 EmbeddingSegment, kept in RAM for scoring.
+
+    float16 halves the memory of the vectors, int8 (with one float32 scale per row) quarters it.
+    Scores are approximate, so the caller should rescore the best candidates with the full precision vectors.
+
+    Stored in its own segment files next to the full one (`<path>.f16`, or `<path>.i8` plus `<path>.scales`),
+    and caught up with the full segment when opened.
+
+    External methods:
+    --
+    append(vector) -- quantize and store one vector
+    append_many(vectors) -- same for a batch, with one write per file
+    scores(query, start, stop) -- approximate dot products of rows start:stop with query
+    """
+
+    def __init__(self, full_segment, precision):
+        self.precision = precision
+        path = full_segment.path
+        if precision == 'float16':
+            self.rows_segment = EmbeddingSegment(f'{path}.f16', dtype='<f2')
+            self.scales_segment = None
+        elif precision == 'int8':
+            self.rows_segment = EmbeddingSegment(f'{path}.i8', dtype='i1')
+            self.scales_segment = EmbeddingSegment(f'{path}.scales')
+        else:
+            raise ValueError(f'unknown precision {precision}, must be float16 or int8')
+
+        self._sync(full_segment)
+        self.rows = RowBuffer(self.rows_segment.read_all())
+        if self.scales_segment is not None:
+            self.scales = RowBuffer(self.scales_segment.read_all())
+
+    def __len__(self):
+        return self.rows.n_rows
+
+    def _sync(self, full_segment):
+        # a row can be in the full segment but not here, if the app was closed between the two appends
+        segments = [s for s in [self.rows_segment, self.scales_segment] if s is not None]
+        n_rows = min([len(s) for s in segments])
+        for s in segments:
+            if len(s) > n_rows:
+                s.truncate(n_rows)
+        if n_rows > len(full_segment):
+            # the full segment dropped an unfinished store
+            for s in segments:
+                s.truncate(len(full_segment))
+            n_rows = len(full_segment)
+        if n_rows == len(full_segment):
+            return
+
+        print(f'quantizing {len(full_segment)-n_rows} rows to {self.precision}')
+        full = full_segment.memmap()
+        for start in range(n_rows, len(full_segment), 8192):
+            compact, scales = quantize(full[start:start+8192], self.precision)
+            self.rows_segment.append_many(compact)
+            if self.scales_segment is not None:
+                self.scales_segment.append_many(scales)
+
+    def append(self, vector):
+        self.append_many(np.asarray(vector).reshape(1, -1))
+
+    def append_many(self, vectors):
+        compact, scales = quantize(vectors, self.precision)
+        self.rows_segment.append_many(compact)
+        self.rows.extend(compact)
+        if self.scales_segment is not None:
+            self.scales_segment.append_many(scales)
+            self.scales.extend(scales)
+
+    def scores(self, query, start, stop):
+        block = self.rows.array[start:stop].astype(np.float32)
+        scores = np.dot(block, query)
+        if self.scales_segment is not None:
+            scores *= self.scales.array[start:stop, 0]
+        return scores
+
+
+class TextSegment:
+    """Append-only file of variable-length utf-8 records, record n belongs to row n of the embedding segment.
+
+    Layout:
+    --
+    header -- magic (8 bytes), format version (uint32), zero-padded to 16 bytes
+    records -- record length in bytes (uint32), then the utf-8 bytes
+
+    Like EmbeddingSegment, a record that was only half-written is cut off the next time the file is opened.
+
+    External methods:
+    --
+    append_many(texts) -- append a list of strings, returns the row id of the first one
+    read_all() -- returns all records as a list of strings
+    truncate(n_rows) -- drop every record from n_rows onwards
+    """
+
+    magic = b'EMBTXT\x00\x00'
+    version = 1
+    header_size = 16
+    length_format = '<I'
+
+    def __init__(self, path):
+        self.path = path
+        self.ends = []  # byte offset where each record ends
+
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            header = struct.pack('<8sI', self.magic, self.version).ljust(self.header_size, b'\x00')
+            with open(path, 'wb') as f:
+                f.write(header)
+                f.flush()
+                os.fsync(f.fileno())
+            return
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version = struct.unpack('<8sI', data[:12])
+        if magic != self.magic:
+            raise ValueError(f'{path} is not a text segment file')
+        if version != self.version:
+            raise ValueError(f'{path} has format version {version}, expected {self.version}')
+
+        pos = self.header_size
+        while pos + 4 <= len(data):
+            length, = struct.unpack_from(self.length_format, data, pos)
+            if pos + 4 + length > len(data):
+                break
+            pos += 4 + length
+            self.ends.append(pos)
+
+        if pos != len(data):
+            print(f'{path}: dropping {len(data)-pos} bytes of a partially written record')
+            with open(path, 'r+b') as f:
+                f.truncate(pos)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def append_many(self, texts):
+        first_row = len(self.ends)
+        end = self.ends[-1] if self.ends else self.header_size
+        chunks = []
+        for text in texts:
+            raw = text.encode('utf-8')
+            chunks.append(struct.pack(self.length_format, len(raw)) + raw)
+            end += 4 + len(raw)
+            self.ends.append(end)
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+        return first_row
+
+    def read_all(self):
+        with open(self.path, 'rb') as f:
+            data = f.read(self.ends[-1] if self.ends else 0)
+        texts = []
+        start = self.header_size
+        for end in self.ends:
+            texts.append(data[start+4:end].decode('utf-8'))
+            start = end
+        return texts
+
+    def truncate(self, n_rows):
+        assert 0 <= n_rows <= len(self.ends)
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.ends[n_rows-1] if n_rows > 0 else self.header_size)
+            f.flush()
+            os.fsync(f.fileno())
+        self.ends = self.ends[:n_rows]
+
+
+class QueryCache:
+    """Least-recently-used cache of query embeddings, keyed by content hash, with at most `capacity` entries.
+
+    Vectors are kept in `capacity` fixed slots of an EmbeddingSegment at `path`, an evicted entry's slot is overwritten.
+    `<path>.json` lists the cached hashes with their slots, least recently used first.
+    Its order is saved with every put, so lookups after the last put are forgotten when the app closes.
+
+    External methods:
+    --
+    get(digest) -- the cached vector or None, marks it as recently used
+    put(digest, vector) -- cache a vector, evicting the least recently used one when full
+    """
+
+    def __init__(self, path, capacity=1000):
+        self.segment = EmbeddingSegment(path)
+        self.index_path = f'{path}.json'
+        self.capacity = capacity
+        self.entries = OrderedDict()  # digest -> (slot, vector), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            vectors = self.segment.read_all()
+            for key, slot in index:
+                if slot < len(vectors):
+                    self.entries[bytes.fromhex(key)] = (slot, vectors[slot])
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _save_index(self):
+        index = [[digest.hex(), slot] for digest, (slot, vector) in self.entries.items()]
+        with open(f'{self.index_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{self.index_path}.tmp', self.index_path)
+
+    def get(self, digest):
+        if digest not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(digest)
+        return self.entries[digest][1]
+
+    def put(self, digest, vector):
+        if digest in self.entries:
+            self.entries.move_to_end(digest)
+            return
+        vector = np.asarray(vector, dtype=np.float32)
+
+        if len(self.entries) >= self.capacity:
+            evicted, (slot, old_vector) = self.entries.popitem(last=False)
+            # the slot is unlisted before it is overwritten, so a crash can't pair a hash with the wrong vector
+            self._save_index()
+        else:
+            used = {slot for slot, v in self.entries.values()}
+            slot = next((s for s in range(len(self.segment)) if s not in used), len(self.segment))
+
+        if slot == len(self.segment):
+            self.segment.append(vector)
+        else:
+            self.segment.write_rows([slot], vector.reshape(1, -1))
+        self.entries[digest] = (slot, vector)
+        self._save_index()
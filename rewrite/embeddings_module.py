@@ -1,82 +1,481 @@
-import os, time, json, openai, math, time
+import os, time, json, openai, math, time, threading, random, hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 import numpy as np
+from collections import OrderedDict
 from secret_things import openai_key
 
 from overall_imports import text_append, text_create, text_read, open_json, col, make_json
+from embedding_store import EmbeddingSegment, RowBuffer, RowBitmap, CompactCopy, TextSegment, QueryCache
+from metadata_store import SegmentMetadata, SQLiteMetadata, no_hash, legacy_provider
+from search_indexes import IVFIndex, HNSWIndex, SignatureIndex, PCAIndex, TagIndex, BM25Index, recall_report
 
 openai.organization = "org-ExxER7UutRm3CU6M9FdszAoE"
 openai.api_key = openai_key
 
-def use_api(string):
+def use_api(string, model='text-embedding-ada-002'):
     """Uses OpenAI API to retrieve ada-002 text embeddings of a string."""
 
     print(col('cy','using api for ') + string)
     if type(string) is not str:
         exit('use_api can only take a string')
-    response = openai.Embedding.create(input=string, model='text-embedding-ada-002')
+    response = openai.Embedding.create(input=string, model=model)
     embedding = response['data'][0]['embedding']
     return embedding
 
+def use_api_batch(strings, model='text-embedding-ada-002'):
+    """Uses OpenAI API to retrieve ada-002 text embeddings of a list of strings, in one request.
+
+    Returns the embeddings in the same order as the strings."""
+
+    print(col('cy', f'using api for {len(strings)} strings'))
+    for string in strings:
+        if type(string) is not str:
+            exit('use_api_batch can only take a list of strings')
+    response = openai.Embedding.create(input=strings, model=model)
+    data = sorted(response['data'], key=lambda item: item['index'])
+    return [item['embedding'] for item in data]
+
+class OpenAIProvider:
+    """The default embedding provider of DataHandler, OpenAI's embeddings api. see lsa_provider.py for the interface."""
+
+    remote = True
+    known_dims = {'text-embedding-ada-002': 1536, 'text-embedding-3-small': 1536, 'text-embedding-3-large': 3072}
+
+    def __init__(self, model='text-embedding-ada-002'):
+        self.model = model
+        self.name = f'openai:{model}'
+        self.dim = self.known_dims.get(model)  # other models: known after the first request
+
+    def embed(self, strings):
+        if len(strings) == 1:
+            embeddings = [use_api(strings[0], self.model)]
+        else:
+            embeddings = use_api_batch(strings, self.model)
+        if self.dim is None and embeddings != []:
+            self.dim = len(embeddings[0])
+        return embeddings
+
+def estimate_tokens(string):
+    # roughly 4 characters per token for english text, good enough for sizing batches
+    return len(string) // 4 + 1
+
+def content_hash(string):
+    """16-byte key of a string in the database.
+
+    Whitespace is normalized first, so chunks that only differ in line breaks or indentation share one embedding."""
+
+    normalized = ' '.join(string.split())
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+
+def rows_checksum(digests, first_row=0):
+    """Checksum of the rows' content hashes, as a sum of one 64 bit hash per row, so it can be extended row by row.
+
+    digests are the content_hash() of the rows' texts, starting at row first_row."""
+
+    checksum = 0
+    for row, digest in enumerate(digests, first_row):
+        checksum += int.from_bytes(hashlib.blake2b(row.to_bytes(8, 'little') + digest, digest_size=8).digest(), 'little')
+    return checksum % 2**64
+
+def make_batches(strings, max_tokens=8000, max_size=2048):
+    """Splits strings into batches of at most max_size strings and about max_tokens tokens.
+
+    A string that is bigger than max_tokens on its own gets a batch to itself."""
+
+    batches = []
+    current = []
+    current_tokens = 0
+    for string in strings:
+        tokens = estimate_tokens(string)
+        if current != [] and (current_tokens + tokens > max_tokens or len(current) >= max_size):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(string)
+        current_tokens += tokens
+    if current != []:
+        batches.append(current)
+    return batches
+
+def top_n_rows(rows, scores, top_n):
+    """Returns the top_n (rows, scores) by score, best first. partial selection, only the winners get sorted."""
+
+    if len(scores) > top_n:
+        keep = np.argpartition(-scores, top_n-1)[:top_n]
+        rows = rows[keep]
+        scores = scores[keep]
+    order = np.argsort(-scores, kind='stable')
+    return rows[order], scores[order]
+
+class RateLimiter:
+    """Keeps api usage under a requests-per-minute and a tokens-per-minute limit. Thread-safe.
+
+    Both budgets refill continuously, acquire(tokens) blocks until both have room."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_budget = requests_per_minute
+        self.token_budget = tokens_per_minute
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        self.request_budget = min(self.requests_per_minute, self.request_budget + minutes*self.requests_per_minute)
+        self.token_budget = min(self.tokens_per_minute, self.token_budget + minutes*self.tokens_per_minute)
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.tokens_per_minute)  # a huge request still has to go through eventually
+        while True:
+            with self.lock:
+                self._refill()
+                if self.request_budget >= 1 and self.token_budget >= tokens:
+                    self.request_budget -= 1
+                    self.token_budget -= tokens
+                    return
+                wait = max(
+                    (1 - self.request_budget) * 60 / self.requests_per_minute,
+                    (tokens - self.token_budget) * 60 / self.tokens_per_minute,
+                )
+            time.sleep(wait)
+
+def use_api_with_retries(provider, batch, rate_limiter, max_retries=6):
+    """provider.embed(batch), waiting for the rate limiter first, and retrying with exponential backoff when rate limited (429)."""
+
+    for attempt in range(max_retries+1):
+        rate_limiter.acquire(sum(map(estimate_tokens, batch)))
+        try:
+            return provider.embed(batch)
+        except openai.error.RateLimitError:
+            if attempt == max_retries:
+                raise
+            # jitter, so workers that got limited together don't retry together
+            delay = min(60, 2**attempt) * (0.5 + random.random()/2)
+            print(col('ye', f'rate limited, retrying in {delay:.1f} seconds'))
+            time.sleep(delay)
+
+class SearchBatcher:
+    """Collects searches from several threads that arrive within `window` seconds of each other,
+    and runs the ones with the same search parameters as one DataHandler.search_many.
+
+    The first thread to arrive waits `window` seconds, then searches for everyone who joined in the meantime.
+    """
+
+    def __init__(self, data_handler, window=0.01):
+        self.data_handler = data_handler
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}  # search params as json -> list of requests
+
+    def search(self, embedded_searchterm, search_parameters):
+        key = json.dumps(search_parameters, sort_keys=True)
+        request = {'query': embedded_searchterm, 'done': threading.Event(), 'result': None, 'error': None}
+        with self.lock:
+            batch = self.pending.setdefault(key, [])
+            batch.append(request)
+            leader = len(batch) == 1
+
+        if not leader:
+            request['done'].wait()
+        else:
+            time.sleep(self.window)
+            with self.lock:
+                batch = self.pending.pop(key)
+            try:
+                results = self.data_handler.search_many([r['query'] for r in batch], search_parameters)
+                for r, result in zip(batch, results):
+                    r['result'] = result
+            except Exception as e:
+                for r in batch:
+                    r['error'] = e
+            for r in batch:
+                r['done'].set()
+
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+class SearchCache:
+    """LRU cache of search results (row ids and scores), for at most `capacity` searches.
+
+    Keyed by a hash of the query vector, the search parameters (has/hasno sorted) and the corpus generation.
+    DataHandler bumps its generation on every change that can change a search result,
+    so an entry from an older generation is never returned, and is dropped at the next put.
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key -> (rows, scores, seconds the search took)
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def key(query, search_parameters, generation):
+        params = dict(search_parameters)
+        for k in ['has', 'hasno']:
+            params[k] = sorted(params[k])
+        vector_hash = hashlib.blake2b(np.ascontiguousarray(query, dtype=np.float32).tobytes(), digest_size=16).digest()
+        return (vector_hash, json.dumps(params, sort_keys=True), generation)
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        rows, scores, seconds = self.entries[key]
+        self.saved_seconds += seconds
+        return rows, scores
+
+    def put(self, key, rows, scores, seconds):
+        generation = key[2]
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+        self.entries[key] = (rows, scores, seconds)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit rate': self.hits / lookups if lookups > 0 else 0.0,
+            'saved seconds': self.saved_seconds,
+            'entries': len(self.entries),
+        }
+
 class DataHandler:
-    """Indexer maps a string to the path where the embedding of that string is stored."""
+    """hash_to_row maps the content hash of a string to the row where the embedding of that string is stored.
 
-    def __init__(self):
+    The float32 vector of every row is stored in an append-only segment file (see embedding_store.py),
+    its hash, text and metadata tags in a metadata store (see metadata_store.py).
+    In memory, row_to_string and row_meta hold the text and tags by row, so each text is kept once.
+
+    Stores only append, so they go straight to those files. Changes to existing rows (set_tags, delete_embedding)
+    are appended to a mutation log instead, replayed over the files at startup,
+    and folded into the metadata store by compact_log() on a background thread once the log has `compact_every` entries.
+
+    Deleted rows stay in the files, marked in the `tombstones` bitmap, which search skips. vacuum() drops them.
+
+    Every row records the name of the provider that embedded it. Only rows of the current provider can be found
+    by their text or by search, vectors from another provider (or another fit of it) aren't comparable.
+    """
+
+    segment_path = 'emb_segment.f32'
+    compact_every = 1000
+    manifest_format = 1
+    min_shard_rows = 16384
+    pca_refit_drift = 1.25
+
+    def __init__(self, memory_mapped=False, block_rows=8192, precision='float32', signatures=False,
+                 api_workers=4, requests_per_minute=3000, tokens_per_minute=1000000, metadata='files',
+                 query_cache_size=1000, search_cache_size=256, search_workers=None, provider=None, lexical=True):
         '''
         mappings you need:
-            - string --> embedding json and metadata
-            - string --> index
+            - content hash --> row in the embedding segment
+            - row --> text and metadata
+
+        memory_mapped -- if True, emb_array is a read-only memory map of the segment file instead of a copy in RAM,
+            and search scans it in blocks of `block_rows` rows, so search memory is bounded by the block size.
+        precision -- 'float32', 'float16' or 'int8'. with float16/int8, search scores a compact copy kept in RAM,
+            then rescores the best candidates with the full precision vectors, which stay memory mapped on disk.
+        signatures -- if True, keeps a 1-bit-per-dimension signature of every row, for search with {'prefilter': 'hamming'}
+        api_workers, requests_per_minute, tokens_per_minute -- how embed_list fetches embeddings.
+            at most api_workers requests at the same time, within the rate limits of the api key
+        metadata -- 'files' or 'sqlite'. where the hash, text and tags of each row are stored.
+            'sqlite' is one transaction per stored batch, answers get_tags/get_common_tags from an index on tag,
+            and can be read by other processes while this one writes. an existing 'files' store is imported on first use
+        query_cache_size -- how many search query embeddings get_query_embedding keeps on disk, outside of the database
+        search_cache_size -- how many search results search and search_many keep in RAM, see search_cache_stats()
+        search_workers -- exact search splits the rows into this many shards and scores them on a thread pool,
+            numpy releases the GIL in the dot products. defaults to the number of cores, at most 8.
+            shards are at least `min_shard_rows` rows, so small databases are searched on the calling thread.
+            with memory_mapped, every worker holds one block, so search memory is search_workers blocks
+        provider -- what turns strings into vectors. defaults to OpenAIProvider(), lsa_provider.LSAProvider works offline.
+            the segment has one dimension, so a provider with another dimension needs its own folder
+        lexical -- if True, keeps a bm25 index of the words of every row, for search with a 'lexical_weight'
+            or {'prefilter': 'bm25'}. costs a few bytes per word of every text in RAM
         '''
-        self.string_to_index = self.get_string_to_index()
-        self.string_to_info = self.get_string_to_info()
+        t0 = time.time()
+        assert precision in ['float32', 'float16', 'int8']
+        assert metadata in ['files', 'sqlite']
+        self.metadata_backend = metadata
+        self.precision = precision
+        self.memory_mapped = memory_mapped or precision != 'float32'
+        self.block_rows = block_rows
+        self.use_signatures = signatures
+        self.use_lexical = lexical
+        self.prefilter_stats = {'searches': 0, 'rows': 0, 'rescored': 0}
+        self.api_workers = api_workers
+        # get_embedding runs on the main thread and on search threads. the lock guards the mappings and emb_array,
+        # in_flight makes callers that want the same uncached string wait for one api request instead of each doing one
+        self.lock = threading.RLock()
+        self.in_flight = {}  # content hash -> {'done': threading.Event, 'result': embedding, 'error': exception}
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.embedding_folder = 'embeddings'  # old one-json-per-vector storage, only used as an import source
+        self.batcher = SearchBatcher(self)
+        self._compactor = None
+        self._pca_fitter = None
+        self._pca_version = 0  # last version handed to a pca fit, see _next_pca_version()
+        self.provider = provider or OpenAIProvider()
+        # query vectors from different providers can't share a cache file
+        self.query_cache_path = f'query_cache.{self.provider.name.replace(":", "-")}.f32'
+        self.query_cache = QueryCache(self.query_cache_path, query_cache_size)
+        self.search_cache = SearchCache(search_cache_size)
+        self.generation = 0  # bumped by every change that can change a search result, see SearchCache
+        self.search_workers = search_workers or min(8, os.cpu_count() or 1)
+        self.search_pool = ThreadPoolExecutor(max_workers=self.search_workers) if self.search_workers > 1 else None
+
+        self.open_store()
+
+        self.init_seconds = time.time() - t0
+        print(col('gr', f'DataHandler.init successful, {len(self.row_to_string)} rows in {self.init_seconds:.3f} seconds'))
+
+    def open_store(self):
+        """Opens the segment and metadata store, and everything that is built from them."""
+
+        self.generation += 1
+        self.finish_vacuum()
+        self.segment = self.get_segment()
+        self.metadata = self.get_metadata_store()
+
+        if len(self.metadata) == 0 and self.metadata_backend == 'sqlite' and SegmentMetadata.exists(self.segment):
+            print('empty sqlite metadata store, importing the metadata files')
+            self.import_metadata_files()
+        elif len(self.metadata) == 0 and os.path.exists('string_to_info.json'):
+            # database from before the metadata store existed
+            print('no metadata store yet, importing the json mappings')
+            self.import_json_mappings()
+        # the manifest is written after every store, so if its row count matches, the last store finished
+        self.manifest = self.get_manifest()
+        manifest_ok = (
+            self.manifest is not None
+            and self.manifest['format'] == self.manifest_format
+            and self.manifest['rows'] == len(self.segment) == len(self.metadata)
+        )
+        if len(self.segment) != len(self.metadata):
+            self.recover_unfinished_store()
+
+        # columns by row id, so search can work with row ids only
+        digests, self.row_to_string, self.row_meta, self.row_provider = self.metadata.read_all()
+        name = self.provider.name
+        self.hash_to_row = {}
+        for row, (digest, provider) in enumerate(zip(digests, self.row_provider)):
+            # a string that was deleted and stored again is found at its newest row
+            if digest != no_hash and provider == name:
+                self.hash_to_row[digest] = row
+        self.tombstones = RowBitmap(len(digests))
+        self.tombstones.set([row for row, digest in enumerate(digests) if digest == no_hash])
+        # rows embedded by another provider stay in the store, but search leaves them out
+        self.other_provider = RowBitmap(len(digests))
+        self.other_provider.set([row for row, provider in enumerate(self.row_provider) if provider != name])
+        if self.other_provider.n_set > 0:
+            print(col('ye', f'{self.other_provider.n_set} rows were embedded by another provider than {name}, search skips them'))
+        if self.provider.dim is not None and self.segment.dim is not None and self.provider.dim != self.segment.dim:
+            raise ValueError(f'{self.provider.name} makes {self.provider.dim} dimensional vectors, the segment has {self.segment.dim}. use another folder')
+        if not manifest_ok:
+            if len(self.row_to_string) > 0:
+                print(col('ye', 'manifest missing or out of date, writing a new one'))
+            self.manifest = {
+                'format': self.manifest_format,
+                'rows': len(self.row_to_string),
+                'checksum': rows_checksum([content_hash(string) for string in self.row_to_string]),
+            }
+            self.write_manifest()
+
         self.emb_array = self.get_emb_array()
-        self.embedding_folder = self.get_emb_folder()
-
-        # i want certainty about the structure.
-        assert type(self.string_to_info) is dict
-        for k,v in self.string_to_info.items():
-            assert type(v) is dict
-            for key in ['path', 'meta']:
-                assert key in v
-            assert type(v['path']) is str
-            assert type(v['meta']) is list
-        
-        if not (len(self.emb_array) == len(self.string_to_index)):
-            print('emb_array and string_to_index are not the same length')
-            print('emb_array:', len(self.emb_array))
-            print('string_to_index:', len(self.string_to_index))
-            self.make_numpy_array()
-        
-        assert len(self.emb_array) == len(self.string_to_index) == len(self.string_to_info)
-        assert self.string_to_index.keys() == self.string_to_info.keys()
-
-        print(col('gr', 'DataHandler.init successful'))
+        self.compact = self.get_compact_copy()
+        self.ivf = self.get_ivf_index()
+        self.pca = self.get_pca_index()
+        self.signatures = self.get_signature_index()
+        self._hnsw = None  # loaded on first use, see get_hnsw_index()
+        self.tag_index = self.get_tag_index()
+        self.bm25 = self.get_bm25_index()
+        self.log = self.get_mutation_log()
+        self.replay_log()
+
+        assert len(self.emb_array) == len(self.row_to_string) == len(self.row_meta) == len(self.row_provider) == self.tombstones.n_rows
 
     
-    # 4 setup helpers
-    def get_string_to_info(self):
-        path = 'string_to_info.json'
-        if path not in os.listdir():
-            make_json({}, path)
-        return open_json(path)
-    def get_string_to_index(self):
-        path = 'string_to_index.json'
-        if path not in os.listdir():
-            make_json({}, path)
-        return open_json(path)
-    def get_emb_folder(self):
-        path = 'embeddings'
-        if path not in os.listdir():
-            os.mkdir(path)
-        return path
+    # setup helpers
+    def get_segment(self):
+        return EmbeddingSegment(self.segment_path)
+    def get_metadata_store(self):
+        if self.metadata_backend == 'sqlite':
+            return SQLiteMetadata(self.segment)
+        return SegmentMetadata(self.segment)
     def get_emb_array(self):
-        path = 'emb_array.npy'
-        if path not in os.listdir():
-            np.save(path, np.array([]))
-        return np.load(path)
+        if self.memory_mapped:
+            return self.segment.memmap()
+        # rows live in a buffer with spare capacity, so storing a vector doesn't copy the whole array
+        self._emb_buffer = RowBuffer(self.segment.read_all())
+        return self._emb_buffer.array
+    def get_compact_copy(self):
+        if self.precision == 'float32':
+            return None
+        return CompactCopy(self.segment, self.precision)
+    def get_ivf_index(self):
+        # only exists after train_ivf() was called once
+        ivf = IVFIndex(self.segment)
+        if not ivf.trained:
+            return None
+        return ivf
+    def get_pca_index(self):
+        # only exists after fit_pca() was called once
+        pca = PCAIndex(self.segment)
+        if not pca.trained:
+            return None
+        return pca
+    def get_signature_index(self):
+        if not self.use_signatures:
+            return None
+        return SignatureIndex(self.segment)
+    def get_tag_index(self):
+        tag_index = TagIndex(self.segment)
+        tag_index.load(self.row_meta)
+        return tag_index
+    def get_bm25_index(self):
+        if not self.use_lexical:
+            return None
+        bm25 = BM25Index(self.segment)
+        bm25.load(self.row_to_string)
+        return bm25
+    def get_manifest(self):
+        # row count, checksum and format version of the segment and metadata store, see verify()
+        path = f'{self.segment_path}.manifest.json'
+        if not os.path.exists(path):
+            return None
+        return open_json(path)
+    def write_manifest(self):
+        # written next to the old one and swapped in, so there is always a complete manifest
+        path = f'{self.segment_path}.manifest.json'
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+    def get_mutation_log(self):
+        # one json entry per change to an existing row, see _log_mutation()
+        return TextSegment(f'{self.segment_path}.log')
+    def get_hnsw_index(self):
+        # only exists after build_hnsw() was called once. loading is slow, so it waits until the first hnsw search
+        if self._hnsw is None and HNSWIndex.exists(self.segment):
+            self._hnsw = HNSWIndex(self.segment)
+            self._hnsw.load(self.emb_array)
+        return self._hnsw
 
     def eat_data(self):
         datafolder = "collecting data for embeddings/data"
         paths = os.listdir(datafolder)
+        contents = []
+        tag_lists = []
         for p in paths:
             tags = []
 
@@ -94,35 +493,105 @@ class DataHandler:
                     lines.append(line)
             
             actual_content = '\n'.join(lines)
-            i = input(f'path:{p}, tag:{tags}. continue?\n')
-            self.get_embedding(actual_content, tags)
+            print(f'path:{p}, tag:{tags}')
+            contents.append(actual_content)
+            tag_lists.append(tags)
+
+        i = input(f'{len(contents)} files. continue?\n')
+        self.embed_list(contents, tag_lists)
+
+    def import_json_mappings(self):
+        """Copies string_to_info.json into the metadata store.
+
+        Only needed once, for a database made before the segment file existed.
+        The vectors, stored as one json file each, are copied into the segment file.
+        The json files are left as they are."""
 
-    def make_numpy_array(self):
-        # make numpy array of embeddings
         t0 = time.time()
-        embeddings_list = []
-        string_to_index = {}
-        for n, (string, info) in enumerate(self.string_to_info.items()):
-            emb_path = info['path']
-            emb = open_json(emb_path)
-            embeddings_list.append(emb)
-            string_to_index[string] = n
-        self.emb_array = np.array(embeddings_list)
-        self.string_to_index = string_to_index
-        print(time.time()-t0, 'seconds to make an np array')
-        np.save('emb_array.npy', self.emb_array)
-        make_json(string_to_index, 'string_to_index.json')
+        string_to_info = open_json('string_to_info.json')
+        strings = list(string_to_info.keys())
+        self.import_json_embeddings([string_to_info[string]['path'] for string in strings])
 
-    def _find_embedding(self, string):
+        self.metadata.truncate(0)
+        if strings != []:
+            digests = [content_hash(string) for string in strings]
+            self.metadata.append_many(digests, strings, [string_to_info[string]['meta'] for string in strings], [legacy_provider] * len(strings))
+        print(time.time()-t0, f'seconds to import {len(strings)} strings from the json mappings')
 
-        idx = self.string_to_index.get(string, None)
-        if idx != None:
-            emb = self.emb_array[idx]
-            return 'success', emb
+    def import_metadata_files(self):
+        """Copies the .hash, .text and .meta files of the 'files' metadata store into the sqlite one."""
+
+        t0 = time.time()
+        digests, texts, metas, providers = SegmentMetadata(self.segment).read_all()
+        if digests != []:
+            self.metadata.append_many(digests, texts, metas, providers)
+        print(time.time()-t0, f'seconds to import {len(digests)} rows from the metadata files')
+
+    def import_json_embeddings(self, paths):
+        """Copies embeddings from the old one-json-file-per-vector storage into the segment file."""
+
+        t0 = time.time()
+        embeddings_list = [open_json(path) for path in paths]
+        self.segment.truncate(0)
+        if embeddings_list != []:
+            self.segment.append_many(np.array(embeddings_list, dtype=np.float32))
+        print(time.time()-t0, f'seconds to import {len(embeddings_list)} json embeddings')
+
+    def recover_unfinished_store(self):
+        """Repairs the state left behind by a crash in the middle of _store_embeddings.
+
+        _store_embeddings appends the hashes, texts and tags of a batch to the metadata store first,
+        then the vectors, so both are cut back to the rows that made it into both of them."""
+
+        n_rows = min(len(self.segment), len(self.metadata))
+        print(col('ye', 'embedding segment and metadata store are out of sync, dropping the unfinished store'))
+        print(f'segment rows: {len(self.segment)}, metadata rows: {len(self.metadata)}')
+
+        self.segment.truncate(n_rows)
+        self.metadata.truncate(n_rows)
+
+    def _append_row(self, embedding):
+        """Appends a vector to the segment file and to emb_array, returns its row."""
+        return self._append_rows(np.asarray(embedding, dtype=np.float32).reshape(1, -1))
+
+    def _append_rows(self, embeddings):
+        """Appends a batch of vectors to the segment file and to emb_array, with one write per file. Returns the first row."""
+
+        first_row = self.segment.append_many(embeddings)
+        assert first_row == len(self.emb_array)
+
+        if self.compact is not None:
+            self.compact.append_many(embeddings)
+        if self.ivf is not None:
+            self.ivf.add_many(first_row, embeddings)
+        if self.pca is not None:
+            self.pca.add_many(embeddings)
+        if self.signatures is not None:
+            self.signatures.add_many(embeddings)
+
+        if self.memory_mapped:
+            # the file grew, so map it again
+            self.emb_array = self.segment.memmap()
         else:
-            indexer = self.string_to_index
-            if string in indexer:
-                emb = open_json(indexer[string]['path'])
+            self._emb_buffer.extend(embeddings)
+            self.emb_array = self._emb_buffer.array
+
+        # a graph that isn't loaded yet picks the new rows up when it is loaded
+        if self._hnsw is not None:
+            for row in range(first_row, first_row + len(embeddings)):
+                self._hnsw.add(row, self.emb_array)
+        for _ in range(len(embeddings)):
+            self.tombstones.append()
+        if self.pca is not None:
+            self._check_pca_drift()
+        return first_row
+
+    def _find_embedding(self, string):
+
+        with self.lock:
+            idx = self.hash_to_row.get(content_hash(string), None)
+            if idx != None:
+                emb = self.emb_array[idx]
                 return 'success', emb
             else:
                 return 'fail', None
@@ -136,24 +605,78 @@ class DataHandler:
         for item in meta:
             assert type(item) is str
 
-        # make json file of embedding
-        emb_path = f'{self.embedding_folder}/{time.time()}.json'
-        make_json(embedding, emb_path)
+        self._store_embeddings([string], [embedding], [meta])
+
+    def _store_embeddings(self, strings, embeddings, metas):
+        """Stores several embeddings. The hashes, texts, tags and vectors are each appended once per batch."""
 
-        # update the mappings
-        self.string_to_info[string] = {'path': emb_path, 'meta': meta}
-        make_json(self.string_to_info, 'string_to_info.json')
-        self.string_to_index[string] = len(self.emb_array)
-        make_json(self.string_to_index, 'string_to_index.json')
-        self.make_numpy_array()
+        with self.lock:
+            new = {}  # content hash -> (string, embedding, meta). a dict drops strings that only differ in whitespace
+            for string, embedding, meta in zip(strings, embeddings, metas):
+                digest = content_hash(string)
+                if digest not in self.hash_to_row and digest not in new:
+                    new[digest] = (string, embedding, meta)
+            if new == {}:
+                return
 
-        assert len(self.emb_array) == len(self.string_to_index) == len(self.string_to_info)
+            digests = list(new.keys())
+            vectors = np.array([new[digest][1] for digest in digests], dtype=np.float32)
+            if self.segment.dim is not None and vectors.shape[1] != self.segment.dim:
+                raise ValueError(f'{self.provider.name} made {vectors.shape[1]} dimensional vectors, the segment has {self.segment.dim}. use another folder')
+
+            # rows are only complete once the vector is in the segment, see recover_unfinished_store()
+            self.metadata.append_many(
+                digests,
+                [new[digest][0] for digest in digests],
+                [new[digest][2] for digest in digests],
+                [self.provider.name] * len(digests),
+            )
+
+            first_row = self._append_rows(vectors)
+            for row, digest in enumerate(digests, first_row):
+                string, embedding, meta = new[digest]
+                self.hash_to_row[digest] = row
+                self.row_to_string.append(string)
+                self.row_meta.append(meta)
+                self.row_provider.append(self.provider.name)
+                self.other_provider.append()
+                self.tag_index.add(meta)
+                if self.bm25 is not None:
+                    self.bm25.add(string)
+
+            assert len(self.emb_array) == len(self.row_to_string) == len(self.row_meta)
+            self.generation += 1
+            self.manifest['rows'] = len(self.row_to_string)
+            self.manifest['checksum'] = (self.manifest['checksum'] + rows_checksum(digests, first_row)) % 2**64
+            self.write_manifest()
+
+    def _claim(self, strings):
+        """Registers the strings that are neither stored nor being fetched as in flight for this caller.
+
+        Returns the claimed strings, the caller has to _release() each of them."""
+
+        claimed = []
+        with self.lock:
+            for string in strings:
+                digest = content_hash(string)
+                if digest not in self.hash_to_row and digest not in self.in_flight:
+                    self.in_flight[digest] = {'done': threading.Event(), 'result': None, 'error': None}
+                    claimed.append(string)
+        return claimed
+
+    def _release(self, string, result=None, error=None):
+        # wakes up everyone waiting for the string. it is stored (or failed) by now, so nobody new will wait for it
+        with self.lock:
+            flight = self.in_flight.pop(content_hash(string))
+        flight['result'] = result
+        flight['error'] = error
+        flight['done'].set()
 
     def get_embedding(self, string, meta=['search term']):
         """Will return the embedding of a string.
 
         If the string is embedded, will just return the vector,
-            if not, will use OpenAI's api to get the vector, then store it with metadata, then return the vector."""
+            if not, will use self.provider to get the vector, then store it with metadata, then return the vector."""
 
         assert type(string) is str
         assert type(meta) is list
@@ -163,22 +686,382 @@ class DataHandler:
         report, emb = self._find_embedding(string)
         if report == 'success':
             return emb            
-        else:
-            emb = use_api(string)
+
+        # either fetch it ourselves, or wait for the thread that is already fetching it.
+        # that thread may only be fetching it as a search query, then it isn't stored after the wait, so try again
+        digest = content_hash(string)
+        while True:
+            with self.lock:
+                report, emb = self._find_embedding(string)
+                if report == 'success':
+                    return emb
+                if self._claim([string]) != []:
+                    cached = self.query_cache.get(digest)
+                    break
+                flight = self.in_flight[digest]
+            self._wait_for(flight)
+
+        try:
+            # a string that was searched for before doesn't need the api
+            emb = self.provider.embed([string])[0] if cached is None else cached.tolist()
             self._store_embedding(string, emb, meta)
-            return emb
+        except Exception as e:
+            self._release(string, error=e)
+            raise
+        self._release(string, result=emb)
+        return emb
+
+    def get_query_embedding(self, string):
+        """Will return the embedding of a search query, without storing it in the database.
+
+        A string that is in the database uses its stored vector. Others go through query_cache,
+        a bounded LRU cache on disk, and only use the api when they aren't cached.
+        So searching never adds rows, and the database doesn't fill up with old queries."""
+
+        assert type(string) is str
+
+        digest = content_hash(string)
+        with self.lock:
+            report, emb = self._find_embedding(string)
+            if report == 'success':
+                return emb
+            emb = self.query_cache.get(digest)
+            if emb is not None:
+                return emb
+            claimed = self._claim([string]) != []
+            flight = self.in_flight[digest]
+
+        if not claimed:
+            return self._wait_for(flight)
 
-    def embed_list(self, lst, meta_lst):
+        try:
+            emb = self.provider.embed([string])[0]
+            with self.lock:
+                self.query_cache.put(digest, emb)
+        except Exception as e:
+            self._release(string, error=e)
+            raise
+        self._release(string, result=emb)
+        return emb
+
+    def _wait_for(self, flight):
+        flight['done'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+
+    def embed_list(self, lst, meta_lst, max_batch_tokens=8000):
+        """Embeds and stores every string in lst that isn't stored yet, with the matching list of tags from meta_lst.
+
+        Strings are sent to the api in batches of about max_batch_tokens tokens, one request per batch.
+        Up to self.api_workers requests run at the same time, within self.rate_limiter.
+        Only this thread writes to the database, as each batch comes back.
+        A provider that isn't remote embeds the batches on this thread, without the rate limiter."""
+
+        uncached = {}  # string -> meta, for strings not in the database. a dict drops duplicates
         for item, meta in zip(lst, meta_lst):
+            assert type(item) is str
             assert type(meta) is list
-            self.get_embedding(item, meta)
+            for tag in meta:
+                assert type(tag) is str
+            if item not in uncached:
+                uncached[item] = meta
+
+        # strings that another thread is already fetching are left to that thread,
+        # and of strings that only differ in whitespace only the first one is sent
+        claimed = self._claim(list(uncached.keys()))
+
+        batches = make_batches(claimed, max_batch_tokens)
+        print(f'embedding {len(claimed)} new strings of {len(lst)} in {len(batches)} requests')
+        def store(batch, embs):
+            self._store_embeddings(batch, embs, [uncached[item] for item in batch])
+            for item, emb in zip(batch, embs):
+                self._release(item, result=emb)
+
+        try:
+            if not self.provider.remote:
+                for batch in batches:
+                    store(batch, self.provider.embed(batch))
+            else:
+                with ThreadPoolExecutor(max_workers=self.api_workers) as pool:
+                    futures = {pool.submit(use_api_with_retries, self.provider, batch, self.rate_limiter): batch for batch in batches}
+                    for future in as_completed(futures):
+                        store(futures[future], future.result())
+        except Exception as e:
+            for item in claimed:
+                if content_hash(item) in self.in_flight:
+                    self._release(item, error=e)
+            raise
+
+        # strings that were in flight as search queries are embedded, but not stored yet
+        for item, meta in uncached.items():
+            if content_hash(item) not in self.hash_to_row:
+                self.get_embedding(item, meta)
     
     def delete_embedding(self, string):
-        if string in self.string_to_index:
-            del self.string_to_index[string]
-            return True
-        else:
-            return False
+        return self.delete_embeddings([string]) == 1
+
+    def delete_embeddings(self, strings):
+        """Deletes stored strings, returns how many of them were stored.
+
+        Their rows get a tombstone, so search skips them, and stay in the files until vacuum()."""
+
+        with self.lock:
+            rows = {}  # content hash -> row
+            for string in strings:
+                digest = content_hash(string)
+                if digest in self.hash_to_row:
+                    rows[digest] = self.hash_to_row[digest]
+            self._log_mutations([{'op': 'delete', 'row': row} for row in rows.values()])
+            for digest in rows:
+                del self.hash_to_row[digest]
+            self.tombstones.set(list(rows.values()))
+            if rows != {}:
+                self.generation += 1
+            return len(rows)
+
+    def set_tags(self, string, meta):
+        """Replaces the metadata tags of a stored string. Returns False if the string isn't stored."""
+
+        return self.set_tags_many([string], [meta]) == 1
+
+    def set_tags_many(self, strings, meta_lst):
+        """Replaces the metadata tags of stored strings, returns how many of them were stored."""
+
+        for meta in meta_lst:
+            assert type(meta) is list
+            for item in meta:
+                assert type(item) is str
+
+        with self.lock:
+            changes = []
+            for string, meta in zip(strings, meta_lst):
+                row = self.hash_to_row.get(content_hash(string), None)
+                if row is not None:
+                    changes.append((row, meta))
+            self._log_mutations([{'op': 'retag', 'row': row, 'meta': meta} for row, meta in changes])
+            for row, meta in changes:
+                self.tag_index.set_tags(row, self.row_meta[row], meta)
+                self.row_meta[row] = meta
+            if changes != []:
+                self.generation += 1
+            return len(changes)
+
+    def _log_mutations(self, entries):
+        # entries are on disk before the change is made in memory, so a crash can't lose a change that was reported done
+        if entries == []:
+            return
+        self.log.append_many([json.dumps(entry) for entry in entries])
+        if len(self.log) >= self.compact_every and (self._compactor is None or not self._compactor.is_alive()):
+            self._compactor = threading.Thread(target=self.compact_log, daemon=True)
+            self._compactor.start()
+
+    def replay_log(self):
+        """Applies the mutations that weren't compacted yet to the in-memory columns and the tag index."""
+
+        entries = [json.loads(entry) for entry in self.log.read_all()]
+        for entry in entries:
+            row = entry['row']
+            if row >= len(self.row_meta):
+                # the row itself was dropped by recover_unfinished_store
+                continue
+            if entry['op'] == 'retag':
+                self.tag_index.set_tags(row, self.row_meta[row], entry['meta'])
+                self.row_meta[row] = entry['meta']
+            elif entry['op'] == 'delete':
+                digest = content_hash(self.row_to_string[row])
+                if self.hash_to_row.get(digest) == row:
+                    del self.hash_to_row[digest]
+                self.tombstones.set([row])
+        if entries != []:
+            print(f'replayed {len(entries)} mutations from the log')
+
+    def compact_log(self):
+        """Folds the mutation log into the metadata store and the tag index file, then empties the log.
+
+        Replaying an entry twice does the same as once, so a crash in the middle just leaves entries to replay."""
+
+        with self.lock:
+            entries = [json.loads(entry) for entry in self.log.read_all()]
+            if entries == []:
+                return
+            t0 = time.time()
+            metas_by_row = {}
+            deleted_rows = set()
+            for entry in entries:
+                if entry['row'] >= len(self.row_meta):
+                    continue
+                if entry['op'] == 'retag':
+                    metas_by_row[entry['row']] = entry['meta']
+                elif entry['op'] == 'delete':
+                    deleted_rows.add(entry['row'])
+
+            if metas_by_row != {}:
+                self.metadata.set_metas(metas_by_row)
+            if deleted_rows != set():
+                self.metadata.clear_hashes(sorted(deleted_rows))
+            self.tag_index.save()
+            self.log.truncate(0)
+            print(time.time()-t0, f'seconds to compact {len(entries)} mutations')
+
+    def vacuum(self):
+        """Drops the deleted rows from the segment and the metadata store, and renumbers the rows that are left.
+
+        Everything is written to new files first (`<file>.vacuum`), then swapped in by finish_vacuum(),
+        which completes the swap at the next start if the app stops in the middle.
+        The files that hold row ids (compact copy, signatures, ivf lists, pca rows, tag and bm25 index, hnsw graph) are deleted,
+        and rebuilt from the new segment, the hnsw graph only if it existed.
+        A background pca fit that is running is waited for first, it reads the old segment."""
+
+        fitter = self._pca_fitter
+        if fitter is not None:
+            fitter.join()
+        with self.lock:
+            self.compact_log()
+            if self.tombstones.n_set == 0:
+                print('no deleted rows to vacuum')
+                return
+
+            t0 = time.time()
+            keep = np.nonzero(~self.tombstones.array)[0]
+            had_hnsw = HNSWIndex.exists(self.segment)
+            for name in os.listdir():
+                if name.startswith(f'{self.segment_path}.vacuum'):
+                    os.remove(name)
+
+            # the new segment, and the new metadata store next to it, at <file>.vacuum<suffix>
+            new_segment = EmbeddingSegment(f'{self.segment_path}.vacuum')
+            new_segment.append_many(np.zeros((0, self.segment.dim), dtype=np.float32))
+            full = self.segment.memmap()
+            for start in range(0, len(keep), self.block_rows):
+                new_segment.append_many(full[keep[start:start+self.block_rows]])
+            del full
+            if self.metadata_backend == 'sqlite':
+                new_metadata = SQLiteMetadata(new_segment)
+            else:
+                new_metadata = SegmentMetadata(new_segment)
+            if len(keep) > 0:
+                new_metadata.append_many(
+                    [content_hash(self.row_to_string[row]) for row in keep],
+                    [self.row_to_string[row] for row in keep],
+                    [self.row_meta[row] for row in keep],
+                    [self.row_provider[row] for row in keep],
+                )
+            new_metadata.close()
+            self.metadata.close()
+
+            swaps = [[new_segment.path, self.segment_path]] + [[new, old] for new, old in zip(new_metadata.paths(), self.metadata.paths())]
+            row_id_files = [f'{self.segment_path}{suffix}' for suffix in ['.f16', '.i8', '.scales', '.sign', '.ivf', '.tags.npz', '.bm25.npz', '.hnsw.npz', '.manifest.json']]
+            if self.pca is not None:
+                # the components still fit, only the projected rows are renumbered
+                row_id_files.append(self.pca.segment.path)
+            plan = json.dumps({'swaps': swaps, 'delete': row_id_files})
+            with open(f'{self.segment_path}.vacuum.plan', 'w', encoding='utf-8') as f:
+                f.write(plan)
+                f.flush()
+                os.fsync(f.fileno())
+
+            print(time.time()-t0, f'seconds to write {len(keep)} rows, dropping {self.tombstones.n_set} deleted rows')
+            self._release_mappings()
+            self.open_store()
+            if had_hnsw:
+                self.build_hnsw()
+
+    def verify(self, repair=False):
+        """Full consistency check of the store, reads every row. Startup only compares the manifest's row count.
+
+        Checks that the segment, metadata store, manifest and the files built from the segment have the same rows,
+        that the manifest checksum matches the texts, that every hash matches its text,
+        that all tags are lists of strings, that every row has a provider and that all vectors are finite.
+        Prints and returns the problems it finds, an empty list if there are none.
+
+        repair=True drops rows that aren't in both the segment and the metadata store,
+        and writes a new manifest from what is left."""
+
+        with self.lock:
+            problems = []
+            n_rows = len(self.segment)
+            if len(self.metadata) != n_rows:
+                problems.append(f'segment has {n_rows} rows, metadata store has {len(self.metadata)}')
+            if self.manifest['rows'] != n_rows:
+                problems.append(f'segment has {n_rows} rows, manifest says {self.manifest["rows"]}')
+            built = [('tag index', self.tag_index.n_rows)]
+            if self.bm25 is not None:
+                built.append(('bm25 index', self.bm25.n_rows))
+            if self.compact is not None:
+                built.append(('compact copy', len(self.compact)))
+            if self.signatures is not None:
+                built.append(('signatures', len(self.signatures.segment)))
+            if self.ivf is not None:
+                built.append(('ivf index', len(self.ivf.assignments)))
+            if self.pca is not None:
+                built.append(('pca rows', len(self.pca.segment)))
+            for name, length in built:
+                if length != n_rows:
+                    problems.append(f'{name} has {length} rows, segment has {n_rows}')
+
+            digests, texts, metas, providers = self.metadata.read_all()
+            if rows_checksum([content_hash(text) for text in texts]) != self.manifest['checksum']:
+                problems.append('manifest checksum does not match the stored texts')
+            for row, (digest, text, meta, provider) in enumerate(zip(digests, texts, metas, providers)):
+                if digest != no_hash and digest != content_hash(text):
+                    problems.append(f'row {row}: hash does not match its text')
+                if type(meta) is not list or any(type(tag) is not str for tag in meta):
+                    problems.append(f'row {row}: tags are not a list of strings')
+                if provider == '':
+                    problems.append(f'row {row}: no provider')
+
+            vectors = self.segment.memmap()
+            for start in range(0, len(vectors), self.block_rows):
+                block = vectors[start:start+self.block_rows]
+                for row in np.nonzero(~np.isfinite(block).all(axis=1))[0]:
+                    problems.append(f'row {start+row}: vector is not finite')
+            vectors = block = None  # the mapping is released before a repair truncates the segment
+
+            for problem in problems:
+                print(col('re', problem))
+            if problems == []:
+                print(col('gr', f'verified {n_rows} rows'))
+            elif repair:
+                self._release_mappings()
+                if len(self.segment) != len(self.metadata):
+                    self.recover_unfinished_store()
+                os.remove(f'{self.segment_path}.manifest.json')
+                self.metadata.close()
+                self.open_store()
+            return problems
+
+    def _release_mappings(self):
+        # windows can't replace or truncate a file while it is memory mapped, open_store() maps it again
+        self.emb_array = None
+        self._hnsw = None
+
+    def finish_vacuum(self):
+        """Swaps in the files written by vacuum(). Does nothing if there is no finished vacuum plan.
+
+        Safe to run again after a crash in the middle, files that were already swapped are skipped."""
+
+        plan_path = f'{self.segment_path}.vacuum.plan'
+        if not os.path.exists(plan_path):
+            # a vacuum that stopped before its plan was written, the old files are still complete
+            for name in os.listdir():
+                if name.startswith(f'{self.segment_path}.vacuum'):
+                    os.remove(name)
+            return
+
+        plan = json.loads(text_read(plan_path))
+        # files with old row ids go first, so they can't be caught up with the new segment by mistake
+        for path in plan['delete']:
+            if os.path.exists(path):
+                os.remove(path)
+        for new, old in plan['swaps']:
+            if os.path.exists(new):
+                for leftover in [f'{old}-wal', f'{old}-shm']:
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+                os.replace(new, old)
+        os.remove(plan_path)
+        print('swapped in the vacuumed files')
 
     '''
     helpers for users:
@@ -186,17 +1069,30 @@ class DataHandler:
         - get_common_tags(tag) to find tags that appear together with `tag`
     '''
     def get_tags(self):
-        tags = []
-        for info in self.string_to_info.values():
-            tags += info['meta']
-        return list(set(tags))
+        # under the lock, the sqlite connection is shared with the background log compactor
+        with self.lock:
+            if self.metadata_backend == 'sqlite':
+                # the queries only see changes that are compacted
+                self.compact_log()
+                return self.metadata.get_tags()
+            tags = []
+            for meta, deleted in zip(self.row_meta, self.tombstones.array):
+                if not deleted:
+                    tags += meta
+            return list(set(tags))
 
     def get_common_tags(self, tag):
-        tags = []
-        for info in self.string_to_info.values():
-            other_tags = [t for t in info['meta'] if t != tag]
-            tags += other_tags
-        return list(set(tags))
+        with self.lock:
+            if self.metadata_backend == 'sqlite':
+                self.compact_log()
+                return self.metadata.get_common_tags(tag)
+            tags = []
+            for meta, deleted in zip(self.row_meta, self.tombstones.array):
+                if deleted or tag not in meta:
+                    continue
+                other_tags = [t for t in meta if t != tag]
+                tags += other_tags
+            return list(set(tags))
 
     def search(self, embedded_searchterm, search_parameters):
         """
@@ -211,112 +1107,609 @@ class DataHandler:
             assert k in search_parameters
         print(f'search params: {search_parameters}')
 
-        top_n = search_parameters['n']
-        hasno = search_parameters['hasno']
-        has = search_parameters['has']
+        t0 = time.time()
+
+        with self.lock:
+            assert len(self.emb_array) == len(self.row_to_string) == len(self.row_meta)
+
+            # the same query with the same parameters on an unchanged corpus gives the same rows
+            key = self.search_cache.key(embedded_searchterm, search_parameters, self.generation)
+            cached = self.search_cache.get(key)
+            if cached is None:
+                # only row ids and scores go through the search, text/path/tags are looked up for the winning rows at the end
+                rows, scores = self._search_rows(embedded_searchterm, search_parameters)
+                self.search_cache.put(key, rows, scores, time.time()-t0)
+            else:
+                rows, scores = cached
+            result = self._rows_to_results(rows, scores)
+
+        if cached is not None:
+            stats = self.search_cache.stats()
+            print(f'search cache hit, hit rate {stats["hit rate"]:.0%}, {stats["saved seconds"]:.3f} seconds saved so far')
+        print(f'search took {time.time()-t0} seconds')
+
+        print(col('re', '=============================='))
+
+        return result
+
+    def search_many(self, embedded_searchterms, search_parameters):
+        """Like search, for several query embeddings with the same search parameters. Returns a list of results, one per query.
+
+        Exact search scores all queries against the corpus in one matrix product per block.
+        The other backends (see _search_rows) search the queries one by one."""
+
+        assert type(search_parameters) is dict
+        for k in ['n', 'hasno', 'has']:
+            assert k in search_parameters
+        print(f'search params: {search_parameters}, {len(embedded_searchterms)} queries')
 
         t0 = time.time()
 
-        assert len(self.emb_array) == len(self.string_to_index) == len(self.string_to_info)
-
-        embeddings_iterable = self.emb_array
-        scores = np.dot(self.emb_array, embedded_searchterm)  # <-- the embedding similarity scores
-
-        strings_iterable = [string.encode('utf-8') for string in self.string_to_info.keys()]
-        paths_iterable = [item['path'].encode('utf-8') for item in self.string_to_info.values()]
-        metatags_iterable = [item['meta'] for item in self.string_to_info.values()]
-
-        my_types = [
-            ('score', float),
-            ('embedded text', f'S{max(map(len,strings_iterable))}'),
-            ('path', f'S{max(map(len,paths_iterable))}'),
-            ('meta tags', list),
-        ]
-        # creates a neat numpy array so you can do np.sort and apply a filter mask
-        combined = list(zip(scores, strings_iterable, paths_iterable, metatags_iterable))
-        combined_array = np.array(combined, dtype=my_types)
-
-        # create boolean filter mask. (i think thats what its called)
-        filtermask = []
-        # for creating a filter mask.
-        def checker(meta_tags, has, hasno):
-            # deal breakers return False. if it survives, it returns True
-            for existing_tag in meta_tags:
-                if existing_tag in hasno:
-                    return False
-            for required in has:
-                if required not in meta_tags:
-                    return False
-            return True
-
-        # use checker to... actually create the boolean filter mask
-        print(len(metatags_iterable), len(combined_array))
-        assert len(metatags_iterable) == len(combined_array)
-        for item in metatags_iterable:
-            if checker(item, has, hasno):
-                filtermask.append(True)
+        with self.lock:
+            return self._search_many_locked(embedded_searchterms, search_parameters, t0)
+
+    def _search_many_locked(self, embedded_searchterms, search_parameters, t0):
+        assert len(self.emb_array) == len(self.row_to_string) == len(self.row_meta)
+
+        exact = (
+            self.compact is None
+            and search_parameters.get('index', 'exact') == 'exact'
+            and search_parameters.get('prefilter') is None
+            and search_parameters.get('lexical_weight', 0) == 0
+            and len(self.emb_array) > 0
+        )
+        keys = [self.search_cache.key(query, search_parameters, self.generation) for query in embedded_searchterms]
+        per_query = [self.search_cache.get(key) for key in keys]
+        missing = [i for i, cached in enumerate(per_query) if cached is None]
+
+        if exact and len(missing) > 0:
+            filtermask = self._filter_mask(search_parameters['has'], search_parameters['hasno'])
+            queries = np.asarray([embedded_searchterms[i] for i in missing], dtype=np.float32)
+            searched = self._search_many_blocks(queries, filtermask, search_parameters['n'])
+        else:
+            searched = [self._search_rows(embedded_searchterms[i], search_parameters) for i in missing]
+        seconds = (time.time()-t0) / max(1, len(missing))
+        for i, (rows, scores) in zip(missing, searched):
+            per_query[i] = (rows, scores)
+            self.search_cache.put(keys[i], rows, scores, seconds)
+        results = [self._rows_to_results(rows, scores) for rows, scores in per_query]
+
+        if len(missing) < len(per_query):
+            print(f'search cache: {len(per_query)-len(missing)} of {len(per_query)} queries were cached')
+
+        print(f'search_many took {time.time()-t0} seconds')
+        print(col('re', '=============================='))
+
+        return results
+
+    def search_cache_stats(self):
+        """Hits, misses, hit rate and seconds saved by the search result cache since startup."""
+
+        with self.lock:
+            return self.search_cache.stats()
+
+    def search_batched(self, embedded_searchterm, search_parameters):
+        """Same as search, but searches from other threads that arrive at about the same time
+        are combined into one search_many. Meant for searches that run on background threads."""
+
+        return self.batcher.search(embedded_searchterm, search_parameters)
+
+    def _search_rows(self, embedded_searchterm, search_parameters):
+        """Picks the search backend from search_parameters, returns (rows, scores), best first.
+
+        optional search_parameters:
+            index -- 'exact' (default), 'ivf' (needs train_ivf() first) or 'hnsw' (needs build_hnsw() first)
+            nprobe -- for 'ivf', how many posting lists to score. default 8
+            ef_search -- for 'hnsw', how many candidates the graph search keeps. default 50
+            prefilter -- 'hamming' to pick candidates by sign-bit hamming distance before exact scoring
+                (needs DataHandler(signatures=True)), or 'pca' to pick them by score in the pca space (needs fit_pca() first).
+                only for the 'exact' index
+            candidates -- for 'hamming' and 'pca', how many candidates get exact scores. default 256
+            rescore -- with a float16/int8 precision, how many candidates to rescore with full precision
+            lexical_weight -- between 0 (default, vector scores only) and 1 (bm25 scores only).
+                above 0, the vector and bm25 scores are mixed with this weight, see _search_hybrid()
+            text -- the words of the query, needed for lexical_weight and the 'bm25' prefilter
+
+        prefilter 'bm25' only scores the vectors of rows that have at least one word of `text`,
+        it works with any lexical_weight, and needs DataHandler(lexical=True) like lexical_weight does.
+        """
+
+        if len(self.emb_array) == 0:
+            # a new store, emb_array doesn't even have a dimension yet
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        lexical_weight = float(search_parameters.get('lexical_weight', 0))
+        if lexical_weight != 0:
+            return self._search_hybrid(embedded_searchterm, search_parameters, lexical_weight)
+
+        top_n = search_parameters['n']
+        filtermask = self._filter_mask(search_parameters['has'], search_parameters['hasno'])
+        index = search_parameters.get('index', 'exact')
+
+        if index == 'ivf':
+            if self.ivf is None:
+                raise ValueError('no ivf index yet, call DataHandler.train_ivf() first')
+            return self._search_ivf(embedded_searchterm, filtermask, top_n, search_parameters.get('nprobe', 8))
+        elif index == 'hnsw':
+            hnsw = self.get_hnsw_index()
+            if hnsw is None:
+                raise ValueError('no hnsw graph yet, call DataHandler.build_hnsw() first')
+            return hnsw.search(embedded_searchterm, top_n, int(search_parameters.get('ef_search', 50)), filtermask)
+        elif index != 'exact':
+            raise ValueError(f'unknown index {index}')
+
+        prefilter = search_parameters.get('prefilter')
+        if prefilter == 'hamming':
+            if self.signatures is None:
+                raise ValueError('hamming prefilter needs DataHandler(signatures=True)')
+            return self._search_hamming(embedded_searchterm, filtermask, top_n, search_parameters.get('candidates', 256))
+        elif prefilter == 'pca':
+            if self.pca is None:
+                raise ValueError('no pca projection yet, call DataHandler.fit_pca() first')
+            return self._search_pca(embedded_searchterm, filtermask, top_n, search_parameters.get('candidates', 256))
+        elif prefilter == 'bm25':
+            matches = np.nonzero(filtermask & (self._lexical_scores(search_parameters) > 0))[0]
+            return self._rescore_candidates('bm25', np.asarray(embedded_searchterm, dtype=np.float32), matches, filtermask, top_n)
+        elif prefilter is not None:
+            raise ValueError(f'unknown prefilter {prefilter}')
+
+        if self.compact is not None:
+            return self._search_compact(embedded_searchterm, filtermask, top_n, search_parameters.get('rescore'))
+        elif self.memory_mapped:
+            return self._search_blocks(embedded_searchterm, filtermask, top_n)
+        return self._search_exact(embedded_searchterm, filtermask, top_n)
+
+    def _lexical_scores(self, search_parameters):
+        # bm25 score of every row for the words in search_parameters['text']
+        if self.bm25 is None:
+            raise ValueError('lexical search needs DataHandler(lexical=True)')
+        if 'text' not in search_parameters:
+            raise ValueError("lexical search needs the words of the query in search_parameters['text']")
+        return self.bm25.scores(search_parameters['text'])
+
+    def _search_hybrid(self, embedded_searchterm, search_parameters, lexical_weight):
+        """Mixes vector and bm25 scores: (1 - lexical_weight) * vector score + lexical_weight * bm25 score / best bm25 score.
+
+        Candidates are the best `candidates` rows (default 256) by vector search, with the other search_parameters,
+        and the best `candidates` rows by bm25, so a row can win on either side. Both scores are computed for all of them.
+        Returns (rows, mixed scores), best first."""
+
+        if not 0 <= lexical_weight <= 1:
+            raise ValueError(f'lexical_weight has to be between 0 and 1, not {lexical_weight}')
+        top_n = search_parameters['n']
+        n_candidates = max(top_n, int(search_parameters.get('candidates', 256)))
+        query = np.asarray(embedded_searchterm, dtype=np.float32)
+
+        vector_rows, _ = self._search_rows(query, dict(search_parameters, n=n_candidates, lexical_weight=0))
+        lexical = self._lexical_scores(search_parameters)
+        filtermask = self._filter_mask(search_parameters['has'], search_parameters['hasno'])
+        matches = filtermask & (lexical > 0)
+        lexical_rows, _ = top_n_rows(np.nonzero(matches)[0], lexical[matches], n_candidates)
+
+        rows = np.union1d(np.asarray(vector_rows, dtype=np.int64), np.asarray(lexical_rows, dtype=np.int64))
+        vector_scores = np.dot(self.emb_array[rows], query)
+        lexical_scores = lexical[rows]
+        if len(rows) > 0 and lexical_scores.max() > 0:
+            lexical_scores = lexical_scores / lexical_scores.max()
+        return top_n_rows(rows, (1 - lexical_weight) * vector_scores + lexical_weight * lexical_scores, top_n)
+
+    def _filter_mask(self, has, hasno):
+        """Boolean array over rows, True for the rows that pass the has/hasno filter,
+        aren't deleted and were embedded by the current provider."""
+
+        mask = self.tag_index.mask(has, hasno)
+        if self.tombstones.n_set > 0:
+            mask &= ~self.tombstones.array
+        if self.other_provider.n_set > 0:
+            mask &= ~self.other_provider.array
+        return mask
+
+    def _shards(self):
+        """Splits the rows into one (start, stop) range per search worker."""
+
+        n_rows = len(self.emb_array)
+        if self.search_pool is None or n_rows < 2*self.min_shard_rows:
+            return [(0, n_rows)]
+        shard_rows = max(self.min_shard_rows, -(-n_rows // self.search_workers))
+        return [(start, min(start+shard_rows, n_rows)) for start in range(0, n_rows, shard_rows)]
+
+    def _map_shards(self, search_shard):
+        """Runs search_shard(start, stop) for every shard, on the search pool if there is more than one."""
+
+        shards = self._shards()
+        if len(shards) == 1:
+            return [search_shard(*shards[0])]
+        return list(self.search_pool.map(lambda shard: search_shard(*shard), shards))
+
+    def _search_exact(self, embedded_searchterm, filtermask, top_n):
+        """Scores emb_array in one dot product per shard, only the rows that pass the filter.
+        The top_n of every shard are merged into the overall top_n. Returns (rows, scores), best first."""
+
+        query = np.asarray(embedded_searchterm, dtype=np.float32)
+
+        def search_shard(start, stop):
+            rows = np.nonzero(filtermask[start:stop])[0]
+            scores = self._score_rows(self.emb_array[start:stop], rows, query)
+            return top_n_rows(rows + start, scores, top_n)
+
+        per_shard = self._map_shards(search_shard)
+        return top_n_rows(
+            np.concatenate([rows for rows, scores in per_shard]),
+            np.concatenate([scores for rows, scores in per_shard]),
+            top_n,
+        )
+
+    def _score_rows(self, vectors, rows, query):
+        # with a restrictive filter, gathering the surviving rows first is cheaper than scoring everything
+        if len(rows) < len(vectors) // 2:
+            return np.dot(vectors[rows], query)
+        return np.dot(vectors, query)[rows]
+
+    def _search_blocks(self, embedded_searchterm, filtermask, top_n, scorer=None):
+        """Exact search that scores emb_array `block_rows` rows at a time, keeping a running top_n.
+
+        Works on a memory map without ever holding more than one block of vectors (per shard) and top_n scores.
+        scorer(query, start, stop) can replace the dot product with emb_array, for example to score a compact copy.
+        Shards are searched in parallel, see _shards(). Returns (rows, scores), best first."""
+
+        query = np.asarray(embedded_searchterm, dtype=np.float32)
+        per_shard = self._map_shards(
+            lambda start, stop: self._search_block_range(query, filtermask, top_n, scorer, start, stop)
+        )
+        return top_n_rows(
+            np.concatenate([rows for rows, scores in per_shard]),
+            np.concatenate([scores for rows, scores in per_shard]),
+            top_n,
+        )
+
+    def _search_block_range(self, query, filtermask, top_n, scorer, range_start, range_stop):
+        # the block loop of _search_blocks, over rows range_start:range_stop
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+
+        for start in range(range_start, range_stop, self.block_rows):
+            stop = min(start+self.block_rows, range_stop)
+            block_mask = filtermask[start:stop]
+            if not block_mask.any():
+                continue
+            rows = np.nonzero(block_mask)[0]
+            if scorer is None:
+                scores = self._score_rows(self.emb_array[start:stop], rows, query)
             else:
-                filtermask.append(False)
+                scores = scorer(query, start, stop)[rows]
+            rows = rows + start
+
+            # merge with the running top_n
+            best_rows, best_scores = top_n_rows(
+                np.concatenate([best_rows, rows]),
+                np.concatenate([best_scores, scores]),
+                top_n,
+            )
+
+        return best_rows, best_scores
+
+    def _search_many_blocks(self, queries, filtermask, top_n):
+        """Exact search for a (queries, dim) matrix, one matrix product per block of `block_rows` rows,
+        keeping a running top_n per query. Shards are searched in parallel, see _shards().
+        Returns a list of (rows, scores), best first, one per query."""
+
+        n_queries = len(queries)
+        per_shard = self._map_shards(
+            lambda start, stop: self._search_many_block_range(queries, filtermask, top_n, start, stop)
+        )
+        best_rows, best_scores = self._merge_many(
+            np.concatenate([rows for rows, scores in per_shard]),
+            np.concatenate([scores for rows, scores in per_shard]),
+            top_n,
+        )
+
+        order = np.argsort(-best_scores, axis=0, kind='stable')
+        best_rows = np.take_along_axis(best_rows, order, axis=0)
+        best_scores = np.take_along_axis(best_scores, order, axis=0)
+        return [(best_rows[:, i], best_scores[:, i]) for i in range(n_queries)]
+
+    def _search_many_block_range(self, queries, filtermask, top_n, range_start, range_stop):
+        # the block loop of _search_many_blocks, over rows range_start:range_stop. the top_n isn't sorted yet
+        n_queries = len(queries)
+        best_rows = np.zeros((0, n_queries), dtype=np.int64)
+        best_scores = np.zeros((0, n_queries), dtype=np.float32)
+
+        for start in range(range_start, range_stop, self.block_rows):
+            stop = min(start+self.block_rows, range_stop)
+            rows = np.nonzero(filtermask[start:stop])[0]
+            if len(rows) == 0:
+                continue
+            scores = np.dot(self.emb_array[start:stop][rows], queries.T)  # (rows, queries)
+            rows = np.repeat((rows + start)[:, None], n_queries, axis=1)
+
+            # merge with the running top_n of every query at once
+            best_rows, best_scores = self._merge_many(
+                np.concatenate([best_rows, rows]),
+                np.concatenate([best_scores, scores]),
+                top_n,
+            )
+        return best_rows, best_scores
+
+    @staticmethod
+    def _merge_many(rows, scores, top_n):
+        # keeps the top_n of every column of (candidates, queries) matrices, unsorted
+        if len(scores) > top_n:
+            keep = np.argpartition(-scores, top_n-1, axis=0)[:top_n]
+            rows = np.take_along_axis(rows, keep, axis=0)
+            scores = np.take_along_axis(scores, keep, axis=0)
+        return rows, scores
+
+    def _search_compact(self, embedded_searchterm, filtermask, top_n, rescore=None):
+        """Scores the compact copy, then rescores the best `rescore` candidates with full precision.
+
+        Only the candidate rows are read from the memory mapped full precision segment.
+        Returns (rows, scores), best first."""
+
+        if rescore is None:
+            rescore = max(10*top_n, 100)
+        rescore = max(int(rescore), top_n)
+        candidates, _ = self._search_blocks(embedded_searchterm, filtermask, rescore, scorer=self.compact.scores)
+
+        # sorted rows read the memory map front to back
+        candidates = np.sort(candidates)
+        query = np.asarray(embedded_searchterm, dtype=np.float32)
+        scores = np.dot(self.emb_array[candidates], query)
+        return top_n_rows(candidates, scores, top_n)
+
+    def _search_ivf(self, embedded_searchterm, filtermask, top_n, nprobe):
+        """Scores only the rows in the nprobe ivf lists closest to the query. Returns (rows, scores), best first."""
+
+        query = np.asarray(embedded_searchterm, dtype=np.float32)
+        candidates = self.ivf.candidates(query, int(nprobe))
+        candidates = np.sort(candidates[filtermask[candidates]])
+        scores = np.dot(self.emb_array[candidates], query)
+        return top_n_rows(candidates, scores, top_n)
+
+    def _search_hamming(self, embedded_searchterm, filtermask, top_n, n_candidates, quiet=False):
+        """Ranks rows by hamming distance of their sign signature, then exact scores only the best n_candidates.
+
+        Keeps count of how many exact scores it saved in self.prefilter_stats, unless quiet. Returns (rows, scores), best first."""
+
+        query = np.asarray(embedded_searchterm, dtype=np.float32)
+        candidates = self.signatures.candidates(query, max(int(n_candidates), top_n), filtermask)
+        return self._rescore_candidates('hamming', query, candidates, filtermask, top_n, quiet)
+
+    def _search_pca(self, embedded_searchterm, filtermask, top_n, n_candidates, quiet=False):
+        """Ranks rows by their score in the pca space, then exact scores only the best n_candidates.
+
+        Keeps count of how many exact scores it saved in self.prefilter_stats, unless quiet. Returns (rows, scores), best first."""
+
+        query = np.asarray(embedded_searchterm, dtype=np.float32)
+        candidates = self.pca.candidates(query, max(int(n_candidates), top_n), filtermask)
+        return self._rescore_candidates('pca', query, candidates, filtermask, top_n, quiet)
 
-        assert len(filtermask) == len(combined_array)
-        # apply filter mask
-        combined_array = combined_array[filtermask]
+    def _rescore_candidates(self, prefilter, query, candidates, filtermask, top_n, quiet=False):
+        # exact scores for the candidates a prefilter picked, in row order so the reads are sequential.
+        # quiet for the recall reports, which run hundreds of searches
+        candidates = np.sort(candidates)
+        scores = np.dot(self.emb_array[candidates], query)
+        if quiet:
+            return top_n_rows(candidates, scores, top_n)
 
-        # sort by score, get top_n
-        transformed = np.sort(combined_array, order='score')
-        transformed = reversed(transformed[-top_n:])
+        n_filtered = int(filtermask.sum())
+        self.prefilter_stats['searches'] += 1
+        self.prefilter_stats['rows'] += n_filtered
+        self.prefilter_stats['rescored'] += len(candidates)
+        if n_filtered > 0:
+            print(f'{prefilter} prefilter: scored {len(candidates)} of {n_filtered} rows ({100 - 100*len(candidates)/n_filtered:.1f}% saved)')
+        return top_n_rows(candidates, scores, top_n)
+
+    def train_ivf(self, n_lists=None, iterations=20):
+        """Trains the ivf index used by search with {'index': 'ivf'}. n_lists defaults to 4*sqrt(rows).
+
+        Rows stored afterwards are added to the nearest list, retrain when the corpus has changed a lot.
+        Stores from other threads wait until it is done."""
+
+        with self.lock:
+            ivf = IVFIndex(self.segment)
+            ivf.train(self.emb_array, n_lists, iterations)
+            self.ivf = ivf
+            self.generation += 1
+
+    def fit_pca(self, dims=128, sample_rows=20000):
+        """Fits the pca projection used by search with {'prefilter': 'pca'}, on a random sample of `sample_rows` rows.
+
+        Rows stored afterwards are projected as they come in. Once enough of them fit the projection worse than
+        the sample did (see PCAIndex.drift), it is fit again on a background thread.
+        A background fit that is running is waited for first, this one replaces its result."""
+
+        fitter = self._pca_fitter
+        if fitter is not None:
+            fitter.join()
+        with self.lock:
+            pca = PCAIndex(self.segment, load=False)
+            pca.fit(self.emb_array, dims, sample_rows, version=self._next_pca_version())
+            pca.save()
+            self.pca = pca
+            self.generation += 1
+
+    def _check_pca_drift(self):
+        enough_rows = self.pca.new_rows >= max(1000, len(self.emb_array) // 10)
+        if enough_rows and self.pca.drift() > self.pca_refit_drift and (self._pca_fitter is None or not self._pca_fitter.is_alive()):
+            print(f'pca drift {self.pca.drift():.2f} after {self.pca.new_rows} new rows, fitting it again in the background')
+            self._pca_fitter = threading.Thread(target=self._refit_pca, daemon=True)
+            self._pca_fitter.start()
+
+    def _next_pca_version(self):
+        # under self.lock. every fit gets its own rows file, so one that is thrown away never deletes the one in use
+        if self.pca is not None:
+            self._pca_version = max(self._pca_version, self.pca.version)
+        self._pca_version += 1
+        return self._pca_version
+
+    def _refit_pca(self):
+        # fits on the rows there are now without holding the lock, then projects the rows stored meanwhile and swaps it in
+        with self.lock:
+            segment, old, vectors = self.segment, self.pca, self.emb_array
+            version = self._next_pca_version()
+        pca = PCAIndex(segment, load=False)
+        pca.fit(vectors, len(old.components), version=version)
+
+        with self.lock:
+            if self.segment is not segment or self.pca is not old:
+                # vacuumed or fit again meanwhile, so these rows are out of date
+                if os.path.exists(pca.segment.path):
+                    os.remove(pca.segment.path)
+                return
+            pca.catch_up(self.emb_array)
+            pca.save()
+            self.pca = pca
+            self.generation += 1
+
+    def _recall_report(self, approx_search, settings, n, n_queries):
+        """Recall@n and latency of approx_search(query, filtermask, n, setting) for every setting, compared with exact search.
+
+        Stored vectors are used as queries. Each query's own row is filtered out of both searches,
+        otherwise it would be the first exact neighbour, that every index finds for free. Returns the report as a list of dicts."""
+
+        def all_but(row):
+            filtermask = np.ones(len(self.emb_array), dtype=bool)
+            filtermask[row] = False
+            return filtermask
+
+        rng = np.random.default_rng(0)
+        query_rows = rng.choice(len(self.emb_array), min(n_queries, len(self.emb_array)), replace=False).tolist()
+        return recall_report(
+            lambda row, n: self._search_blocks(self.emb_array[row], all_but(row), n),
+            lambda row, n, setting: approx_search(self.emb_array[row], all_but(row), n, setting),
+            query_rows,
+            settings,
+            n,
+        )
+
+    def ivf_recall_report(self, nprobes=(1, 2, 4, 8, 16, 32, 64), n=10, n_queries=100):
+        """Recall@n and latency of ivf search for several nprobe values, compared with exact search."""
+        if self.ivf is None:
+            raise ValueError('no ivf index yet, call DataHandler.train_ivf() first')
+        return self._recall_report(self._search_ivf, nprobes, n, n_queries)
+
+    def build_hnsw(self, M=16, ef_construction=100):
+        """Builds the hnsw graph used by search with {'index': 'hnsw'}, and saves it next to the segment.
+
+        Rows stored afterwards are inserted into the graph as they come in.
+        Stores from other threads wait until it is done."""
+
+        with self.lock:
+            hnsw = HNSWIndex(self.segment, M, ef_construction)
+            hnsw.build(self.emb_array)
+            self._hnsw = hnsw
+            self.generation += 1
+
+    def hamming_recall_report(self, n_candidates=(32, 64, 128, 256, 512, 1024), n=10, n_queries=100):
+        """Recall@n and latency of the hamming prefilter for several candidate counts, compared with exact search."""
+        if self.signatures is None:
+            raise ValueError('hamming prefilter needs DataHandler(signatures=True)')
+        return self._recall_report(
+            lambda query, filtermask, n, candidates: self._search_hamming(query, filtermask, n, candidates, quiet=True),
+            n_candidates, n, n_queries,
+        )
+
+    def pca_recall_report(self, n_candidates=(32, 64, 128, 256, 512, 1024), n=10, n_queries=100):
+        """Recall@n and latency of the pca prefilter for several candidate counts, compared with exact search."""
+        if self.pca is None:
+            raise ValueError('no pca projection yet, call DataHandler.fit_pca() first')
+        return self._recall_report(
+            lambda query, filtermask, n, candidates: self._search_pca(query, filtermask, n, candidates, quiet=True),
+            n_candidates, n, n_queries,
+        )
+
+    def hnsw_recall_report(self, ef_searches=(10, 20, 50, 100, 200), n=10, n_queries=100):
+        """Recall@n and latency of hnsw search for several ef_search values, compared with exact search."""
+
+        hnsw = self.get_hnsw_index()
+        if hnsw is None:
+            raise ValueError('no hnsw graph yet, call DataHandler.build_hnsw() first')
+        return self._recall_report(
+            lambda query, filtermask, n, ef_search: hnsw.search(query, n, ef_search, filtermask),
+            ef_searches, n, n_queries,
+        )
+
+    def _rows_to_results(self, rows, scores):
+        """Turns row ids and scores into the result dicts that search returns."""
 
-        # make result usable without needing to know the specifics of the code above.
-        # and the for loop is not costly anymore, with a tiny array.
         result = []
-        for item in transformed:
+        for row, score in zip(rows, scores):
             result.append({
-                'score':round(item[0], 3),
-                'text':item[1].decode('utf-8'),
-                'path':item[2].decode('utf-8'),
-                'meta tags':item[3],
+                'score':round(float(score), 3),
+                'text':self.row_to_string[row],
+                'path':self.segment_path,
+                'meta tags':self.row_meta[row],
             })
+        return result
 
-        print(f'search took {time.time()-t0} seconds')
-
-        print(col('re', '=============================='))
+    def search_and_show(self, search_term, params, separately=False):
+        """search_term can be a string, or a list of strings.
 
-        return result
+        A list is averaged into one search, or with separately=True, searched term by term in one search_many."""
 
-    def search_and_show(self, search_term, params):
         if type(search_term) is str:
-            embedding_to_search = self.get_embedding(search_term, ['search query'])
+            embedding_to_search = self.get_query_embedding(search_term)
         elif type(search_term) is list:
             all_embs = []
             for item in search_term:
-                assert type(item is str)
+                assert type(item) is str
                 all_embs.append(
-                    self.get_embedding(item, ['search query'])
+                    self.get_query_embedding(item)
                 )
-            summed = all_embs[0]
-            for emb in all_embs[1:]:
-                for idx, scalar in enumerate(emb):
-                    summed[idx] += scalar
-            for idx, scalar in enumerate(summed):
-                summed[idx] /= len(all_embs)
-            assert len(summed) == len(all_embs[0])
-            embedding_to_search = summed
+            if not separately:
+                # np.mean makes a new array, so the stored embeddings aren't changed
+                embedding_to_search = np.mean(np.asarray(all_embs, dtype=np.float32), axis=0)
         else:
             raise TypeError
 
         # do search
         print(f'params:{params}')
-        searchres = self.search(embedding_to_search, params)
+        if type(search_term) is list and separately:
+            terms = search_term
+            all_searchres = self.search_many(all_embs, params)
+        else:
+            terms = [search_term]
+            all_searchres = [self.search(embedding_to_search, params)]
 
         # show results nicely.
-        for item in searchres:
-            s = item['score']
-            te = item['text']
-            ta = item['meta tags']
+        for term, searchres in zip(terms, all_searchres):
+            if len(terms) > 1:
+                print(col('ma', f'results for: {term}'))
+            for item in searchres:
+                s = item['score']
+                te = item['text']
+                ta = item['meta tags']
+
+                print(f'score ' + col('cy', s))
+                print(te)
+                print(' '*4 + '--- ' + ', '.join(ta) + ' ---')
+                print()
+
+
+class LazyDataHandler:
+    """Stand-in for a DataHandler that is still being built on a worker thread.
+
+    Takes the same arguments as DataHandler. `ready` is a concurrent.futures.Future of the DataHandler,
+    using any DataHandler attribute or method on this object waits for it, then passes the call on.
+    So windows can be shown right away, and only the first search waits for the database to load.
+    """
 
-            print(f'score ' + col('cy', s))
-            print(te)
-            print(' '*4 + '--- ' + ', '.join(ta) + ' ---')
-            print()
+    def __init__(self, *args, **kwargs):
+        self.ready = Future()
+        self.started = time.time()
+        thread = threading.Thread(target=self._load, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
 
+    def _load(self, *args, **kwargs):
+        try:
+            data_handler = DataHandler(*args, **kwargs)
+        except Exception as e:
+            self.ready.set_exception(e)
+            raise
+        self.ready.set_result(data_handler)
+        print(col('gr', f'data handler ready {time.time()-self.started:.3f} seconds after startup'))
 
+    def __getattr__(self, name):
+        # only called for names this object doesn't have itself
+        if not self.ready.done():
+            print(col('ye', f'waiting for the data handler to load before {name}'))
+        return getattr(self.ready.result(), name)
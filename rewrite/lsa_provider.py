@@ -0,0 +1,149 @@
+"""
+Local embedding provider for embeddings_module.DataHandler, in numpy only. no api key, no network, no cost per string.
+
+- LSAProvider:
+    latent semantic analysis. tf-idf weights over a vocabulary learned from the corpus,
+    projected onto the top singular vectors of the corpus' tf-idf matrix (truncated svd).
+    much weaker than a trained embedding model, but good enough for keyword-ish search,
+    and for running ingestion and search throughput tests offline.
+
+A provider is anything with:
+--
+name -- stored with every row it embedded. rows from other providers are left out of search
+remote -- True if embed() makes network requests, then DataHandler runs them on a pool, within its rate limits
+embed(strings) -- returns one list of floats per string
+
+Fit on the texts of an existing store, then embedded again into a store of its own folder,
+as the vectors don't have the dimension of the api's:
+
+    old = DataHandler()
+    live = [row for row in range(len(old.row_to_string)) if not old.tombstones.array[row]]
+    os.makedirs('lsa_store', exist_ok=True)
+    provider = LSAProvider(os.path.abspath('lsa_store/lsa_model.npz'))
+    provider.fit([old.row_to_string[row] for row in live])
+    provider.save()
+    os.chdir('lsa_store')  # DataHandler keeps its files in the working directory
+    new = DataHandler(provider=provider)
+    new.embed_list([old.row_to_string[row] for row in live], [old.row_meta[row] for row in live])
+"""
+
+import os, re, time, hashlib
+from collections import Counter
+import numpy as np
+
+class LSAProvider:
+    """TF-IDF + truncated SVD embeddings, fit on the corpus with fit() and saved to `path`.
+
+    A string's embedding is its l2-normalized tf-idf vector (sublinear tf) times the term vectors,
+    normalized again, so scores are cosine similarities like the api's embeddings.
+    Words that weren't in the vocabulary are ignored, a string without known words embeds to zeros.
+
+    The name includes a fingerprint of the fit, so rows embedded by an older fit aren't searched with a newer one.
+
+    External methods:
+    --
+    fit(texts, dims, max_vocab, min_df) -- learn the vocabulary, idf weights and term vectors
+    embed(strings)
+    save()
+    """
+
+    remote = False
+    token_pattern = re.compile(r'\w+')
+
+    def __init__(self, path='lsa_model.npz'):
+        self.path = path
+        self.vocab = {}
+        self.idf = None
+        self.term_vectors = None  # vocab size x dims
+        self.name = 'lsa:untrained'
+        if os.path.exists(path):
+            data = np.load(path)
+            self.vocab = {word: i for i, word in enumerate(data['words'].tolist())}
+            self.idf = data['idf']
+            self.term_vectors = data['term_vectors']
+            self._set_name()
+
+    @property
+    def trained(self):
+        return self.term_vectors is not None
+
+    @property
+    def dim(self):
+        return None if self.term_vectors is None else self.term_vectors.shape[1]
+
+    def _set_name(self):
+        fingerprint = hashlib.blake2b(self.term_vectors.tobytes(), digest_size=4).hexdigest()
+        self.name = f'lsa:{self.dim}:{fingerprint}'
+
+    def tokenize(self, string):
+        return self.token_pattern.findall(string.lower())
+
+    def _weights(self, string):
+        # (vocabulary ids, l2-normalized tf-idf weights) of the known words in string
+        counts = Counter(word for word in self.tokenize(string) if word in self.vocab)
+        if counts == {}:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        ids = np.array([self.vocab[word] for word in counts], dtype=np.int64)
+        weights = (1 + np.log(np.array(list(counts.values()), dtype=np.float32))) * self.idf[ids]
+        return ids, weights / np.linalg.norm(weights)
+
+    def fit(self, texts, dims=256, max_vocab=20000, min_df=2, power_iterations=2, seed=0):
+        """Learns the vocabulary (the max_vocab words in the most texts, if in at least min_df of them),
+        the idf weights and `dims` term vectors from texts.
+
+        The svd is randomized (Halko et al.), over the tf-idf matrix in dense blocks of rows,
+        so memory stays at a few blocks plus vocab size x dims."""
+
+        t0 = time.time()
+        df = Counter()
+        for text in texts:
+            df.update(set(self.tokenize(text)))
+        # ties broken by the word, so the same texts always give the same fit
+        words = sorted([word for word, n in df.items() if n >= min_df], key=lambda word: (-df[word], word))[:max_vocab]
+        if words == []:
+            raise ValueError(f'no word is in {min_df} of the texts, nothing to fit')
+        self.vocab = {word: i for i, word in enumerate(words)}
+        self.idf = (np.log((1 + len(texts)) / (1 + np.array([df[word] for word in words], dtype=np.float32))) + 1).astype(np.float32)
+        rows = [self._weights(text) for text in texts]
+        dims = min(dims, len(words), len(texts))
+
+        def blocks(block_rows=1024):
+            for start in range(0, len(rows), block_rows):
+                block = np.zeros((len(rows[start:start+block_rows]), len(words)), dtype=np.float32)
+                for i, (ids, weights) in enumerate(rows[start:start+block_rows]):
+                    block[i, ids] = weights
+                yield start, block
+
+        # an orthonormal basis q for the range of x, then the svd of the small matrix q.T @ x
+        rng = np.random.default_rng(seed)
+        sketch = rng.standard_normal((len(words), dims + 10)).astype(np.float32)
+        for _ in range(power_iterations + 1):
+            y = np.zeros((len(rows), sketch.shape[1]), dtype=np.float32)
+            for start, block in blocks():
+                y[start:start+len(block)] = np.dot(block, sketch)
+            q, _ = np.linalg.qr(y)
+            sketch = np.zeros_like(sketch)
+            for start, block in blocks():
+                sketch += np.dot(block.T, q[start:start+len(block)])
+            # sketch is now x.T @ q, which is (q.T @ x).T
+        u, s, vt = np.linalg.svd(sketch.T, full_matrices=False)
+        self.term_vectors = np.ascontiguousarray(vt[:dims].T, dtype=np.float32)
+        self._set_name()
+        print(f'fit lsa with {dims} dimensions and {len(words)} words on {len(texts)} texts in {time.time()-t0} seconds')
+
+    def embed(self, strings):
+        if not self.trained:
+            raise ValueError('LSAProvider has no model yet, call fit() first')
+        embeddings = np.zeros((len(strings), self.dim), dtype=np.float32)
+        for i, string in enumerate(strings):
+            ids, weights = self._weights(string)
+            embeddings[i] = np.dot(weights, self.term_vectors[ids])
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms > 0, norms, 1)
+        return embeddings.tolist()
+
+    def save(self):
+        tmp_path = f'{self.path[:-len(".npz")]}.tmp.npz'
+        words = sorted(self.vocab, key=self.vocab.get)
+        np.savez(tmp_path, words=np.array(words), idf=self.idf, term_vectors=self.term_vectors)
+        os.replace(tmp_path, self.path)
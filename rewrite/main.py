@@ -279,7 +279,9 @@ def analyze(widget):
 
 class App:
     def __init__(self, root, config_handler):
-        self.data_handler = embeddings_module.DataHandler()
+        t0 = time.time()
+        # loads on a worker thread, so the windows don't wait for the database. the first search waits for it instead
+        self.data_handler = embeddings_module.LazyDataHandler()
         self.config_handler = config_handler
         self.root = root
         
@@ -391,6 +393,9 @@ class App:
         root.bind_all('<KeyPress>', self.global_keypress)
         self.chatgpt_window.bind('<KeyPress>', self.chatgpt_keypress)
 
+        # runs once the windows are drawn and the mainloop is idle
+        root.after_idle(lambda: print(col('gr', f'windows up {time.time()-t0:.3f} seconds after startup')))
+
     def embed_contents(self, widget):
         # not multithreading this because it might go wrong when multiple threads try to edit the same files
 
@@ -416,12 +421,11 @@ class App:
             return stuff
         stuff = get_stuff()
 
-        for text, tags in stuff:
-            # will add the strings to the database, assigning the tags as metadata
-            self.data_handler.get_embedding(
-                text,
-                tags,
-            )
+        # will add the strings to the database, assigning the tags as metadata. batched, one api request per batch
+        self.data_handler.embed_list(
+            [text for text, tags in stuff],
+            [tags for text, tags in stuff],
+        )
 
         print(col('gr', 'done embedding strings'))
 
@@ -0,0 +1,190 @@
+"""
+Row metadata (content hash, text, tags, embedding provider) for embeddings_module.DataHandler, row n belongs to row n of the embedding segment
+
+- SegmentMetadata:
+    hashes, texts, tags and providers in 4 append-only files next to the embedding segment. the default.
+- SQLiteMetadata:
+    the same in an sqlite database, with tags in their own indexed table. inserts are transactions,
+    and other processes can read the database while it is written.
+
+Both have the same methods:
+--
+append_many(digests, texts, metas, providers) -- append rows, returns the row id of the first one
+read_all() -- returns (digests, texts, metas, providers), lists by row
+set_metas(metas_by_row) -- replace the tags of existing rows, {row: meta}
+clear_hashes(rows) -- set the hash of rows to `no_hash`, so they can't be found by their text anymore
+truncate(n_rows) -- drop every row from n_rows onwards
+paths() -- the files of the store, DataHandler.vacuum() swaps them for new ones
+close()
+"""
+
+import os, json, sqlite3
+import numpy as np
+
+from embedding_store import EmbeddingSegment, TextSegment
+
+no_hash = bytes(16)
+# rows imported from the json files of the first version were embedded by the api
+legacy_provider = 'openai:text-embedding-ada-002'
+
+class SegmentMetadata:
+    """Hashes in `<path>.hash` (16 bytes per row), texts in `<path>.text`, tags as json lists in `<path>.meta`,
+    and the name of the provider that embedded the row in `<path>.provider`."""
+
+    def __init__(self, full_segment):
+        path = full_segment.path
+        self.hashes = EmbeddingSegment(f'{path}.hash', dtype='u1')
+        self.texts = TextSegment(f'{path}.text')
+        self.metas = TextSegment(f'{path}.meta')
+        self.providers = TextSegment(f'{path}.provider')
+
+    @classmethod
+    def exists(cls, full_segment):
+        return os.path.exists(f'{full_segment.path}.text')
+
+    def __len__(self):
+        return min(len(self.hashes), len(self.texts), len(self.metas), len(self.providers))
+
+    def append_many(self, digests, texts, metas, providers):
+        first_row = len(self)
+        self.hashes.append_many(np.frombuffer(b''.join(digests), dtype=np.uint8).reshape(-1, 16))
+        self.texts.append_many(texts)
+        self.metas.append_many([json.dumps(meta) for meta in metas])
+        self.providers.append_many(providers)
+        return first_row
+
+    def read_all(self):
+        # a crash between the 4 appends leaves some files a few rows longer
+        self.truncate(len(self))
+        digests = [digest.tobytes() for digest in self.hashes.read_all()]
+        metas = [json.loads(meta) for meta in self.metas.read_all()]
+        return digests, self.texts.read_all(), metas, self.providers.read_all()
+
+    def set_metas(self, metas_by_row):
+        # records are variable-length, so the file is rewritten next to the old one and swapped in
+        metas = self.metas.read_all()
+        for row, meta in metas_by_row.items():
+            metas[row] = json.dumps(meta)
+        tmp_path = f'{self.metas.path}.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        rewritten = TextSegment(tmp_path)
+        rewritten.append_many(metas)
+        os.replace(tmp_path, self.metas.path)
+        rewritten.path = self.metas.path
+        self.metas = rewritten
+
+    def clear_hashes(self, rows):
+        cleared = np.zeros((len(rows), len(no_hash)), dtype=np.uint8)
+        self.hashes.write_rows(rows, cleared)
+
+    def truncate(self, n_rows):
+        for s in [self.hashes, self.texts, self.metas, self.providers]:
+            if len(s) > n_rows:
+                s.truncate(n_rows)
+
+    def paths(self):
+        return [self.hashes.path, self.texts.path, self.metas.path, self.providers.path]
+
+    def close(self):
+        pass
+
+
+class SQLiteMetadata:
+    """Rows and tags in the sqlite database `<path>.sqlite`.
+
+    Tables:
+    --
+    rows -- row (primary key), hash, text, path, provider
+    tags -- row, tag, position of the tag in the row's list. indexed by tag and by row
+
+    External methods, next to the ones in the module docstring:
+    --
+    get_tags() -- every tag in the database
+    get_common_tags(tag) -- every tag that some row has together with `tag`
+    """
+
+    def __init__(self, full_segment):
+        self.path = f'{full_segment.path}.sqlite'
+        self.segment_path = full_segment.path
+        # DataHandler.lock serializes the threads, the busy timeout waits for writes from other processes
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS rows (row INTEGER PRIMARY KEY, hash BLOB NOT NULL, text TEXT NOT NULL, path TEXT NOT NULL, provider TEXT NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS rows_hash ON rows (hash)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS tags (row INTEGER NOT NULL, tag TEXT NOT NULL, position INTEGER NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag, row)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS tags_row ON tags (row, position)')
+        # rows are numbered from 0 without gaps, and only this process writes, so the count is kept here.
+        # MAX on the primary key is a lookup, COUNT(*) would scan the table
+        self.n_rows = self.conn.execute('SELECT COALESCE(MAX(row)+1, 0) FROM rows').fetchone()[0]
+
+    def __len__(self):
+        return self.n_rows
+
+    def append_many(self, digests, texts, metas, providers):
+        first_row = self.n_rows
+        rows = range(first_row, first_row + len(digests))
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO rows (row, hash, text, path, provider) VALUES (?, ?, ?, ?, ?)',
+                [(row, digest, text, self.segment_path, provider) for row, digest, text, provider in zip(rows, digests, texts, providers)],
+            )
+            self.conn.executemany(
+                'INSERT INTO tags (row, tag, position) VALUES (?, ?, ?)',
+                [(row, tag, position) for row, meta in zip(rows, metas) for position, tag in enumerate(meta)],
+            )
+        self.n_rows += len(digests)
+        return first_row
+
+    def read_all(self):
+        digests = []
+        texts = []
+        providers = []
+        for digest, text, provider in self.conn.execute('SELECT hash, text, provider FROM rows ORDER BY row'):
+            digests.append(bytes(digest))
+            texts.append(text)
+            providers.append(provider)
+        metas = [[] for _ in digests]
+        for row, tag in self.conn.execute('SELECT row, tag FROM tags ORDER BY row, position'):
+            metas[row].append(tag)
+        return digests, texts, metas, providers
+
+    def set_metas(self, metas_by_row):
+        with self.conn:
+            self.conn.executemany('DELETE FROM tags WHERE row = ?', [(row,) for row in metas_by_row])
+            self.conn.executemany(
+                'INSERT INTO tags (row, tag, position) VALUES (?, ?, ?)',
+                [(row, tag, position) for row, meta in metas_by_row.items() for position, tag in enumerate(meta)],
+            )
+
+    def clear_hashes(self, rows):
+        with self.conn:
+            self.conn.executemany('UPDATE rows SET hash = ? WHERE row = ?', [(no_hash, row) for row in rows])
+            # so get_tags and get_common_tags only see rows that still exist
+            self.conn.executemany('DELETE FROM tags WHERE row = ?', [(row,) for row in rows])
+
+    def paths(self):
+        return [self.path]
+
+    def close(self):
+        # the last connection to close checkpoints the write-ahead log into the database file and deletes it
+        self.conn.close()
+
+    def truncate(self, n_rows):
+        with self.conn:
+            self.conn.execute('DELETE FROM rows WHERE row >= ?', (n_rows,))
+            self.conn.execute('DELETE FROM tags WHERE row >= ?', (n_rows,))
+        self.n_rows = min(self.n_rows, n_rows)
+
+    def get_tags(self):
+        return [tag for tag, in self.conn.execute('SELECT DISTINCT tag FROM tags')]
+
+    def get_common_tags(self, tag):
+        query = '''
+            SELECT DISTINCT other.tag FROM tags AS this
+            JOIN tags AS other ON other.row = this.row
+            WHERE this.tag = ? AND other.tag != ?
+        '''
+        return [other for other, in self.conn.execute(query, (tag, tag))]
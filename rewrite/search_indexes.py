@@ -0,0 +1,868 @@
+"""
+Approximate nearest neighbour indexes, used by embeddings_module.DataHandler next to its exact search
+
+- IVFIndex:
+    inverted file index. k-means centroids over the vectors, and a posting list of rows per centroid.
+    search only scores the rows in the `nprobe` lists whose centroids are closest to the query.
+- HNSWIndex:
+    hierarchical navigable small world graph, in pure python and numpy. search walks the graph greedily,
+    so its cost grows roughly with log(rows) instead of rows.
+- SignatureIndex:
+    1 bit per dimension (the sign) for every row. ranking rows by hamming distance to the query's signature
+    is a cheap way to pick candidates for exact scoring.
+- PCAIndex:
+    every row projected onto the top principal components of the vectors. scoring the projected rows
+    is a cheap way to pick candidates for exact scoring, and the components are re-fit as the corpus drifts.
+- TagIndex:
+    sorted rows per metadata tag, so has/hasno filters are a few vectorized writes into a boolean mask.
+- BM25Index:
+    inverted index from every word to the rows that have it, for keyword scoring next to the vectors.
+    catches exact names, code identifiers and rare words that embeddings blur.
+- recall_report:
+    compares an approximate search with exact search, for choosing settings.
+"""
+
+import os, re, time, math, random, heapq, zipfile, bisect
+from array import array
+from collections import Counter
+import numpy as np
+
+from embedding_store import EmbeddingSegment, RowBuffer
+
+def savez_replace(path, **arrays):
+    """np.savez to a file next to `path`, then swapped in, so a crash while saving leaves the old file whole."""
+    tmp_path = f'{path[:-len(".npz")]}.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def kmeans(vectors, n_clusters, iterations=20, block_rows=8192, seed=0):
+    """Spherical k-means (dot product similarity, normalized centroids), vectorized over blocks of rows.
+
+    Returns a (n_clusters, dim) float32 array of centroids."""
+
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = np.array(vectors[np.sort(rng.choice(len(vectors), n_clusters, replace=False))], dtype=np.float32)
+
+    for _ in range(iterations):
+        sums = np.zeros_like(centroids)
+        counts = np.zeros(n_clusters, dtype=np.int64)
+        for start in range(0, len(vectors), block_rows):
+            block = np.asarray(vectors[start:start+block_rows], dtype=np.float32)
+            labels = np.argmax(np.dot(block, centroids.T), axis=1)
+            # one-hot matmul adds every row to its centroid's sum in one go
+            onehot = np.zeros((len(block), n_clusters), dtype=np.float32)
+            onehot[np.arange(len(block)), labels] = 1
+            sums += np.dot(onehot.T, block)
+            counts += np.bincount(labels, minlength=n_clusters)
+
+        # empty clusters get a random row, so no centroid is wasted
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[np.sort(rng.choice(len(vectors), int(empty.sum()), replace=False))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = sums / norms
+
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """Inverted file index over the rows of an EmbeddingSegment.
+
+    Files, next to the segment:
+    --
+    `<path>.ivf.npy` -- the centroids
+    `<path>.ivf` -- segment with the posting list (centroid id) of every row, appended to on every insert
+
+    New rows are assigned to the nearest existing centroid, without retraining.
+    When the corpus has changed a lot, call train() again.
+
+    External methods:
+    --
+    train(vectors, n_lists) -- k-means over the vectors, then assigns all of them
+    add(row, vector) -- assign one new row to its nearest list
+    add_many(first_row, vectors) -- same for a batch of new rows
+    candidates(query, nprobe) -- rows in the nprobe lists closest to the query
+    """
+
+    def __init__(self, full_segment):
+        self.centroids_path = f'{full_segment.path}.ivf.npy'
+        self.assignments = EmbeddingSegment(f'{full_segment.path}.ivf', dtype='<i4')
+        self.centroids = None
+        self.lists = []
+
+        if os.path.exists(self.centroids_path):
+            self.centroids = np.load(self.centroids_path)
+            self._sync(full_segment)
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def _assign(self, vectors, block_rows=8192):
+        labels = []
+        for start in range(0, len(vectors), block_rows):
+            block = np.asarray(vectors[start:start+block_rows], dtype=np.float32)
+            labels.append(np.argmax(np.dot(block, self.centroids.T), axis=1))
+        if labels == []:
+            return np.zeros(0, dtype=np.int32)
+        return np.concatenate(labels).astype(np.int32)
+
+    def _sync(self, full_segment):
+        # rows stored after the last assignment (app closed in between, or dropped by a crash)
+        if len(self.assignments) > len(full_segment):
+            self.assignments.truncate(len(full_segment))
+        if len(self.assignments) < len(full_segment):
+            missing = full_segment.memmap()[len(self.assignments):]
+            print(f'assigning {len(missing)} rows to ivf lists')
+            self.assignments.append_many(self._assign(missing).reshape(-1, 1))
+
+        labels = self.assignments.read_all().reshape(-1)
+        self._build_lists(labels)
+
+    def _build_lists(self, labels):
+        self.lists = [[] for _ in range(len(self.centroids))]
+        for row, label in enumerate(labels.tolist()):
+            self.lists[label].append(row)
+
+    def train(self, vectors, n_lists=None, iterations=20):
+        """k-means over the vectors, then (re)assigns every row. n_lists defaults to 4*sqrt(rows)."""
+
+        t0 = time.time()
+        if n_lists is None:
+            n_lists = max(1, int(4*np.sqrt(len(vectors))))
+        self.centroids = kmeans(vectors, n_lists, iterations)
+        # swapped in, so a crash while saving leaves the old centroids whole
+        tmp_path = f'{self.centroids_path[:-len(".npy")]}.tmp.npy'
+        np.save(tmp_path, self.centroids)
+        os.replace(tmp_path, self.centroids_path)
+
+        labels = self._assign(vectors)
+        self.assignments.truncate(0)
+        if len(labels) > 0:
+            self.assignments.append_many(labels.reshape(-1, 1))
+        self._build_lists(labels)
+        print(f'trained ivf index with {len(self.centroids)} lists in {time.time()-t0} seconds')
+
+    def add(self, row, vector):
+        self.add_many(row, np.asarray(vector, dtype=np.float32).reshape(1, -1))
+
+    def add_many(self, first_row, vectors):
+        assert first_row == len(self.assignments)
+        labels = self._assign(vectors)
+        self.assignments.append_many(labels.reshape(-1, 1))
+        for row, label in enumerate(labels.tolist(), first_row):
+            self.lists[label].append(row)
+
+    def candidates(self, query, nprobe):
+        nprobe = min(nprobe, len(self.centroids))
+        centroid_scores = np.dot(self.centroids, query)
+        nearest = np.argpartition(-centroid_scores, nprobe-1)[:nprobe]
+        rows = [np.array(self.lists[label], dtype=np.int64) for label in nearest]
+        return np.concatenate(rows)
+
+
+class HNSWIndex:
+    """Hierarchical navigable small world graph over the rows of an EmbeddingSegment.
+
+    Every row is a node on level 0, and on each level above it with probability 1/M.
+    Search starts at the top level's entry point, walks greedily down to level 0,
+    then does a best-first search there, keeping the `ef` best nodes seen.
+
+    Parameters:
+    --
+    M -- neighbours per node (2*M on level 0). more is better recall, slower inserts, more memory
+    ef_construction -- how wide the search is when inserting. more is a better graph, slower inserts
+    ef_search -- (passed to search) how wide the search is when querying. more is better recall, slower queries
+
+    Saved to `<path>.hnsw.npz` next to the segment, when the rows inserted since the last save
+    are at least `save_every` and a tenth of the graph, so saving stays a small share of the insert time.
+    Rows stored after the last save are inserted again when the graph is loaded.
+
+    External methods:
+    --
+    exists(full_segment) -- True if a saved graph exists for the segment
+    load(vectors) -- load the saved graph, insert the rows that came after it
+    add(row, vectors) -- insert row `row` of vectors
+    search(query, k, ef_search, filtermask) -- returns (rows, scores), best first
+    save()
+    """
+
+    def __init__(self, full_segment, M=16, ef_construction=100, save_every=256):
+        self.path = f'{full_segment.path}.hnsw.npz'
+        self.M = M
+        self.ef_construction = ef_construction
+        self.save_every = save_every
+        self.vectors = None
+        self._reset()
+
+    def _reset(self):
+        self.node_levels = []
+        self.graph = [{}]  # graph[level][row] -> list of neighbour rows
+        self.entry_point = None
+        self.max_level = -1
+        self.unsaved = 0
+
+    @classmethod
+    def exists(cls, full_segment):
+        return os.path.exists(f'{full_segment.path}.hnsw.npz')
+
+    def __len__(self):
+        return len(self.node_levels)
+
+    def _random_level(self, row):
+        # seeded by row, so the same corpus always gives the same graph
+        u = random.Random(row).random()
+        return int(-math.log(1 - u) / math.log(self.M))
+
+    def _scores(self, query, rows):
+        return np.dot(self.vectors[rows], query)
+
+    def _search_layer(self, query, entry_points, ef, level):
+        """Best-first search on one level. Returns a list of (score, row), best first, at most ef long."""
+
+        layer = self.graph[level]
+        visited = set(entry_points)
+        entry_scores = self._scores(query, entry_points).tolist()
+        candidates = [(-score, row) for score, row in zip(entry_scores, entry_points)]  # max-heap by score
+        heapq.heapify(candidates)
+        results = [(score, row) for score, row in zip(entry_scores, entry_points)]  # min-heap by score
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            neg_score, row = heapq.heappop(candidates)
+            if -neg_score < results[0][0] and len(results) >= ef:
+                break
+            neighbours = [n for n in layer.get(row, []) if n not in visited]
+            if neighbours == []:
+                continue
+            visited.update(neighbours)
+            # score all unvisited neighbours in one dot product
+            for score, n in zip(self._scores(query, neighbours).tolist(), neighbours):
+                if len(results) < ef or score > results[0][0]:
+                    heapq.heappush(candidates, (-score, n))
+                    heapq.heappush(results, (score, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted(results, reverse=True)
+
+    def _select(self, query, candidates, max_neighbours):
+        """Picks up to max_neighbours of the candidates, closest first, skipping a candidate that is closer
+        to an already picked neighbour than to the query. keeps links in several directions instead of one cluster."""
+
+        scores = self._scores(query, candidates)
+        order = np.argsort(-scores, kind='stable')
+        candidate_vectors = self.vectors[candidates]
+        picked = []
+        for i in order:
+            if len(picked) >= max_neighbours:
+                break
+            if picked == [] or np.max(np.dot(candidate_vectors[picked], candidate_vectors[i])) < scores[i]:
+                picked.append(i)
+        return [candidates[i] for i in picked]
+
+    def _shrink(self, row, neighbours, max_neighbours):
+        if len(neighbours) <= max_neighbours:
+            return neighbours
+        return self._select(np.asarray(self.vectors[row], dtype=np.float32), neighbours, max_neighbours)
+
+    def _insert(self, row):
+        query = np.asarray(self.vectors[row], dtype=np.float32)
+        level = self._random_level(row)
+        self.node_levels.append(level)
+        while len(self.graph) <= level:
+            self.graph.append({})
+
+        if self.entry_point is None:
+            for lc in range(level+1):
+                self.graph[lc][row] = []
+            self.entry_point = row
+            self.max_level = level
+            return
+
+        # greedy descent through the levels above the new node
+        entry_points = [self.entry_point]
+        for lc in range(self.max_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, lc)[0][1]]
+
+        for lc in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(query, entry_points, self.ef_construction, lc)
+            max_neighbours = 2*self.M if lc == 0 else self.M
+            neighbours = self._select(query, [n for _, n in found], self.M)
+            self.graph[lc][row] = neighbours
+            for n in neighbours:
+                self.graph[lc][n] = self._shrink(n, self.graph[lc][n] + [row], max_neighbours)
+            entry_points = [n for _, n in found]
+
+        for lc in range(self.max_level+1, level+1):
+            self.graph[lc][row] = []
+        if level > self.max_level:
+            self.entry_point = row
+            self.max_level = level
+
+    def add(self, row, vectors):
+        assert row == len(self)
+        self.vectors = vectors
+        self._insert(row)
+        self.unsaved += 1
+        if self.unsaved >= max(self.save_every, len(self) // 10):
+            self.save()
+
+    def build(self, vectors):
+        t0 = time.time()
+        self.vectors = vectors
+        for row in range(len(self), len(vectors)):
+            self._insert(row)
+        self.save()
+        print(f'built hnsw graph of {len(self)} rows in {time.time()-t0} seconds')
+
+    def search(self, query, k, ef_search, filtermask=None):
+        """Returns (rows, scores), best first. Rows where filtermask is False are skipped.
+
+        With a filter, ef is doubled until k rows survive it (or the whole graph was searched)."""
+
+        query = np.asarray(query, dtype=np.float32)
+        if self.entry_point is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        entry_points = [self.entry_point]
+        for lc in range(self.max_level, 0, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, lc)[0][1]]
+
+        ef = max(ef_search, k)
+        while True:
+            found = self._search_layer(query, entry_points, ef, 0)
+            if filtermask is not None:
+                found = [(score, row) for score, row in found if filtermask[row]]
+            if len(found) >= k or ef >= len(self):
+                break
+            ef *= 2
+
+        found = found[:k]
+        rows = np.array([row for _, row in found], dtype=np.int64)
+        scores = np.array([score for score, _ in found], dtype=np.float32)
+        return rows, scores
+
+    def save(self):
+        arrays = {
+            'meta': np.array([self.M, self.ef_construction, self.max_level, -1 if self.entry_point is None else self.entry_point]),
+            'node_levels': np.array(self.node_levels, dtype=np.int8),
+        }
+        # every level as csr: nodes, offsets into the flat neighbour array, flat neighbour array
+        for lc, layer in enumerate(self.graph):
+            nodes = sorted(layer.keys())
+            arrays[f'nodes_{lc}'] = np.array(nodes, dtype=np.int32)
+            arrays[f'offsets_{lc}'] = np.cumsum([0] + [len(layer[n]) for n in nodes]).astype(np.int64)
+            arrays[f'neighbours_{lc}'] = np.array([m for n in nodes for m in layer[n]], dtype=np.int32)
+        savez_replace(self.path, **arrays)
+        self.unsaved = 0
+
+    def load(self, vectors):
+        t0 = time.time()
+        data = np.load(self.path)
+        self.M, self.ef_construction, self.max_level, entry_point = data['meta'].tolist()
+        self.entry_point = None if entry_point == -1 else entry_point
+        self.node_levels = data['node_levels'].tolist()
+        self.graph = []
+        for lc in range(max(self.max_level, 0)+1):
+            nodes = data[f'nodes_{lc}'].tolist()
+            offsets = data[f'offsets_{lc}'].tolist()
+            flat = data[f'neighbours_{lc}'].tolist()
+            self.graph.append({n: flat[offsets[i]:offsets[i+1]] for i, n in enumerate(nodes)})
+
+        # a crash can leave the graph with rows that were dropped from the segment, start over then
+        if len(self) > len(vectors):
+            print('hnsw graph has more rows than the segment, rebuilding it')
+            self._reset()
+        self.vectors = vectors
+        missing = len(vectors) - len(self)
+        for row in range(len(self), len(vectors)):
+            self._insert(row)
+        if missing > 0:
+            self.save()
+        print(f'loaded hnsw graph in {time.time()-t0} seconds, inserted {missing} rows stored since the last save')
+
+
+# number of set bits in every possible byte
+_popcount_table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(arr):
+    if hasattr(np, 'bitwise_count'):  # numpy 2.0+
+        return np.bitwise_count(arr)
+    return _popcount_table[arr]
+
+
+class SignatureIndex:
+    """Sign bit of every dimension of every row, packed 8 per byte. a 1536-dim vector becomes 192 bytes.
+
+    Stored in `<path>.sign` next to the segment, appended to on every insert, caught up when opened.
+
+    External methods:
+    --
+    add(vector)
+    add_many(vectors)
+    candidates(query, k, filtermask) -- the k rows that pass the filter with the smallest hamming distance to the query
+    """
+
+    def __init__(self, full_segment):
+        self.segment = EmbeddingSegment(f'{full_segment.path}.sign', dtype='u1')
+        if len(self.segment) > len(full_segment):
+            self.segment.truncate(len(full_segment))
+        if len(self.segment) < len(full_segment):
+            missing = full_segment.memmap()[len(self.segment):]
+            print(f'making sign signatures for {len(missing)} rows')
+            for start in range(0, len(missing), 8192):
+                self.segment.append_many(self.signatures(missing[start:start+8192]))
+        self.rows = RowBuffer(self.segment.read_all())
+
+    @staticmethod
+    def signatures(vectors):
+        return np.packbits(np.asarray(vectors) > 0, axis=1)
+
+    def add(self, vector):
+        self.add_many(np.asarray(vector).reshape(1, -1))
+
+    def add_many(self, vectors):
+        signatures = self.signatures(vectors)
+        self.segment.append_many(signatures)
+        self.rows.extend(signatures)
+
+    def candidates(self, query, k, filtermask):
+        signature = self.signatures(np.asarray(query).reshape(1, -1))[0]
+        distances = popcount(np.bitwise_xor(self.rows.array, signature)).sum(axis=1, dtype=np.int32)
+        # filtered out rows go to the back
+        distances[~filtermask] = np.iinfo(np.int32).max
+        k = min(k, int(filtermask.sum()))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.argpartition(distances, k-1)[:k]
+
+
+class PCAIndex:
+    """Every row projected onto the top principal components of the vectors, for picking candidates cheaply.
+
+    q.x = q.mean + (C q).(C (x - mean)) + q.(part of x outside the components), and q.mean is the same for every row,
+    so ranking rows by (C q).(C (x - mean)) is exact up to what the components miss.
+    With 128 of 1536 dimensions, scoring the projected rows is about 12x less work than a full scan.
+
+    Files next to the segment:
+    --
+    `<path>.pca.npz` -- mean, components, version, and the average residual of the sample it was fit on
+    `<path>.pca.<version>` -- segment with the projected rows, appended to on every insert, caught up when opened.
+        fit() writes a new version next to the old one, save() switches the .npz over to it and deletes the old one
+
+    External methods:
+    --
+    fit(vectors, dims, sample_rows) -- learn the components from a sample of the vectors, project all of them
+    add(vector) -- project one new row
+    add_many(vectors) -- same for a batch of new rows
+    candidates(query, k, filtermask) -- the k rows that pass the filter with the best projected scores
+    drift() -- average residual of the rows added since opening, relative to the fit sample's. 1.0 is no drift
+    save()
+    """
+
+    def __init__(self, full_segment, load=True):
+        self.full_path = full_segment.path
+        self.params_path = f'{full_segment.path}.pca.npz'
+        self.mean = None
+        self.components = None
+        self.version = 0
+        self.fit_residual = None
+        self.new_rows = 0
+        self.new_residual = 0.0
+
+        if load and os.path.exists(self.params_path):
+            data = np.load(self.params_path)
+            self.mean = data['mean']
+            self.components = data['components']
+            self.version = int(data['version'])
+            self.fit_residual = float(data['fit_residual'])
+            self._remove_other_versions()
+            self.segment = EmbeddingSegment(self._rows_path(self.version))
+            self._sync(full_segment)
+
+    @property
+    def trained(self):
+        return self.components is not None
+
+    def _rows_path(self, version):
+        return f'{self.full_path}.pca.{version}'
+
+    def _remove_other_versions(self):
+        # left behind by a fit that didn't get to save(), or by a crash right after it
+        folder = os.path.dirname(self.full_path) or '.'
+        prefix = f'{os.path.basename(self.full_path)}.pca.'
+        for name in os.listdir(folder):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and suffix.isdigit() and int(suffix) != self.version:
+                os.remove(os.path.join(folder, name))
+
+    def _sync(self, full_segment):
+        # rows stored after the last projection (app closed in between, or dropped by a crash)
+        if len(self.segment) > len(full_segment):
+            self.segment.truncate(len(full_segment))
+        if len(self.segment) < len(full_segment):
+            missing = full_segment.memmap()[len(self.segment):]
+            print(f'projecting {len(missing)} rows onto {len(self.components)} pca components')
+            for start in range(0, len(missing), 8192):
+                self._append(missing[start:start+8192])
+        self.rows = RowBuffer(self.segment.read_all())
+
+    def project(self, vectors):
+        return np.dot(np.asarray(vectors, dtype=np.float32) - self.mean, self.components.T)
+
+    def residuals(self, vectors):
+        # share of each centered vector's squared length that the components don't capture
+        centered = np.asarray(vectors, dtype=np.float32) - self.mean
+        total = (centered**2).sum(axis=1)
+        kept = (np.dot(centered, self.components.T)**2).sum(axis=1)
+        return (total - kept) / np.maximum(total, 1e-12)
+
+    def _append(self, vectors):
+        projected = self.project(vectors)
+        self.segment.append_many(projected)
+        self.new_rows += len(vectors)
+        self.new_residual += float(self.residuals(vectors).sum())
+        return projected
+
+    def fit(self, vectors, dims=128, sample_rows=20000, seed=0, version=None):
+        """Learns the mean and the top `dims` components from a random sample of the vectors,
+        and projects all of them into a new version of the rows file. The saved version is used until save().
+
+        version -- of the new rows file, the one after the loaded one by default.
+            fits that may run at the same time must each get their own"""
+
+        t0 = time.time()
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(vectors), min(len(vectors), sample_rows), replace=False))
+        sample = np.asarray(vectors[sample], dtype=np.float32)
+        self.mean = sample.mean(axis=0)
+        # rows of vt are the principal directions, strongest first
+        u, s, vt = np.linalg.svd(sample - self.mean, full_matrices=False)
+        self.components = np.ascontiguousarray(vt[:dims], dtype=np.float32)
+        self.fit_residual = float(self.residuals(sample).mean())
+
+        self.version = self.version + 1 if version is None else version
+        if os.path.exists(self._rows_path(self.version)):
+            os.remove(self._rows_path(self.version))
+        self.segment = EmbeddingSegment(self._rows_path(self.version))
+        for start in range(0, len(vectors), 8192):
+            self._append(vectors[start:start+8192])
+        if len(vectors) == 0:
+            self.segment.append_many(np.zeros((0, len(self.components)), dtype=np.float32))
+        self.rows = RowBuffer(self.segment.read_all())
+        self.new_rows = 0
+        self.new_residual = 0.0
+        print(f'fit pca with {len(self.components)} components on {len(sample)} rows in {time.time()-t0} seconds, '
+              f'{100*(1-self.fit_residual):.1f}% of the variance kept')
+
+    def catch_up(self, vectors):
+        """Projects the rows of vectors that came after the ones given to fit()."""
+        for start in range(self.rows.n_rows, len(vectors), 8192):
+            for row in self._append(vectors[start:start+8192]):
+                self.rows.append(row)
+
+    def save(self):
+        tmp_path = f'{self.params_path[:-len(".npz")]}.tmp.npz'
+        np.savez(
+            tmp_path,
+            mean=self.mean,
+            components=self.components,
+            version=np.array(self.version),
+            fit_residual=np.array(self.fit_residual),
+        )
+        os.replace(tmp_path, self.params_path)
+        self._remove_other_versions()
+
+    def add(self, vector):
+        self.add_many(np.asarray(vector, dtype=np.float32).reshape(1, -1))
+
+    def add_many(self, vectors):
+        self.rows.extend(self._append(vectors))
+
+    def drift(self):
+        if self.new_rows == 0:
+            return 1.0
+        return (self.new_residual / self.new_rows) / max(self.fit_residual, 1e-12)
+
+    def candidates(self, query, k, filtermask):
+        rows = np.nonzero(filtermask)[0]
+        k = min(k, len(rows))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        projected_query = np.dot(self.components, np.asarray(query, dtype=np.float32))
+        scores = np.dot(self.rows.array, projected_query)
+        return rows[np.argpartition(-scores[rows], k-1)[:k]]
+
+
+class TagIndex:
+    """Inverted index from every metadata tag to the sorted rows that have it.
+
+    Memory and file size grow with the number of (row, tag) pairs, so a tag per document stays cheap.
+    Saved to `<path>.tags.npz` next to the segment, when the rows added since the last save
+    are at least `save_every` and a tenth of the index, so saving stays a small share of the insert time.
+    Rows stored after the last save are added from their tags when it is loaded,
+    and a file that can't be read is rebuilt from the tags.
+
+    External methods:
+    --
+    load(row_meta) -- load the saved index, add the rows that came after it
+    add(meta) -- add the next row, with its list of tags
+    set_tags(row, old_meta, meta) -- change the tags of an existing row, only the postings of old_meta and meta are touched
+    mask(has, hasno) -- boolean array, True for rows that have all of `has` and none of `hasno`
+    save()
+    """
+
+    def __init__(self, full_segment, save_every=256):
+        self.path = f'{full_segment.path}.tags.npz'
+        self.save_every = save_every
+        self.postings = {}  # tag -> array of rows, ascending
+        self.n_rows = 0
+        self.unsaved = 0
+
+    def load(self, row_meta):
+        if os.path.exists(self.path):
+            try:
+                data = np.load(self.path)
+                n_rows = int(data['n_rows'])
+                all_rows = data['rows']
+                starts = np.concatenate([[0], np.cumsum(data['counts'])])
+                postings = {tag: self._array(all_rows[starts[i]:starts[i+1]]) for i, tag in enumerate(data['tags'].tolist())}
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+                print(f'could not read {self.path} ({e!r}), rebuilding the tag index')
+            else:
+                if n_rows <= len(row_meta):
+                    self.n_rows = n_rows
+                    self.postings = postings
+                # else: a crash dropped rows that the index still has, rebuild it from row_meta
+
+        missing = len(row_meta) - self.n_rows
+        for meta in row_meta[self.n_rows:]:
+            self._add(meta)
+        if missing > 0:
+            self.save()
+
+    @staticmethod
+    def _array(values):
+        result = array('i')
+        result.frombytes(np.ascontiguousarray(values, dtype=np.int32).tobytes())
+        return result
+
+    def _add(self, meta):
+        row = self.n_rows
+        for tag in dict.fromkeys(meta):
+            if tag not in self.postings:
+                self.postings[tag] = array('i')
+            self.postings[tag].append(row)
+        self.n_rows += 1
+
+    def add(self, meta):
+        self._add(meta)
+        self.unsaved += 1
+        if self.unsaved >= max(self.save_every, self.n_rows // 10):
+            self.save()
+
+    def set_tags(self, row, old_meta, meta):
+        # checks before every change, so replaying a retag the saved index already has changes nothing
+        for tag in set(old_meta) - set(meta):
+            rows = self.postings.get(tag)
+            if rows is not None:
+                i = bisect.bisect_left(rows, row)
+                if i < len(rows) and rows[i] == row:
+                    rows.pop(i)
+                if len(rows) == 0:
+                    del self.postings[tag]
+        for tag in set(meta) - set(old_meta):
+            rows = self.postings.setdefault(tag, array('i'))
+            i = bisect.bisect_left(rows, row)
+            if i == len(rows) or rows[i] != row:
+                rows.insert(i, row)
+
+    def _rows(self, tag):
+        rows = self.postings.get(tag)
+        if rows is None:
+            return np.zeros(0, dtype=np.int32)
+        return np.frombuffer(rows, dtype=np.int32)
+
+    def mask(self, has, hasno):
+        mask = np.ones(self.n_rows, dtype=bool)
+        for tag in has:
+            column = np.zeros(self.n_rows, dtype=bool)
+            column[self._rows(tag)] = True
+            mask &= column
+        for tag in hasno:
+            mask[self._rows(tag)] = False
+        return mask
+
+    def save(self):
+        tags = list(self.postings.keys())
+        rows = [self._rows(tag) for tag in tags]
+        savez_replace(
+            self.path,
+            n_rows=np.array(self.n_rows),
+            tags=np.array(tags, dtype=str),
+            counts=np.array([len(r) for r in rows], dtype=np.int64),
+            rows=np.concatenate(rows) if rows != [] else np.zeros(0, dtype=np.int32),
+        )
+        self.unsaved = 0
+
+
+class BM25Index:
+    """Inverted index from every word to the rows whose text has it, for BM25 keyword scoring.
+
+    Words are runs of letters, digits and underscores, lowercased, so code identifiers like get_search_params stay whole.
+    Postings are arrays of (row, count), appended to as rows come in.
+    Saved to `<path>.bm25.npz` next to the segment, when the rows added since the last save are at least
+    `save_every` and a tenth of the index, so saving stays a small share of the insert time.
+    Rows stored after the last save are added from their texts when it is loaded.
+
+    External methods:
+    --
+    load(row_to_string) -- load the saved index, add the rows that came after it
+    add(text) -- add the next row
+    scores(text) -- BM25 score of every row for the words of text, 0 for rows without any of them
+    save()
+    """
+
+    token_pattern = re.compile(r'\w+')
+
+    def __init__(self, full_segment, save_every=1024, k1=1.2, b=0.75):
+        self.path = f'{full_segment.path}.bm25.npz'
+        self.save_every = save_every
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # word -> (array of rows, array of counts)
+        self.lengths = array('i')  # words per row
+        self.total_length = 0
+        self.unsaved = 0
+
+    @property
+    def n_rows(self):
+        return len(self.lengths)
+
+    def tokenize(self, text):
+        return self.token_pattern.findall(text.lower())
+
+    def load(self, row_to_string):
+        if os.path.exists(self.path):
+            data = np.load(self.path)
+            n_rows = int(data['n_rows'])
+            if n_rows <= len(row_to_string):
+                self.lengths = self._array(data['lengths'])
+                self.total_length = int(data['lengths'].sum())
+                all_rows, all_counts = data['rows'], data['counts']
+                starts = np.concatenate([[0], np.cumsum(data['df'])])
+                for i, word in enumerate(data['words'].tolist()):
+                    self.postings[word] = (
+                        self._array(all_rows[starts[i]:starts[i+1]]),
+                        self._array(all_counts[starts[i]:starts[i+1]]),
+                    )
+            # else: a crash dropped rows that the index still has, rebuild it from the texts
+
+        missing = len(row_to_string) - self.n_rows
+        if missing > 0:
+            print(f'adding {missing} rows to the bm25 index')
+        for text in row_to_string[self.n_rows:]:
+            self._add(text)
+        if missing > 0:
+            self.save()
+
+    @staticmethod
+    def _array(values):
+        # appendable int32 array, that numpy can read without a copy
+        result = array('i')
+        result.frombytes(np.ascontiguousarray(values, dtype=np.int32).tobytes())
+        return result
+
+    def _add(self, text):
+        row = self.n_rows
+        words = self.tokenize(text)
+        for word, count in Counter(words).items():
+            if word not in self.postings:
+                self.postings[word] = (array('i'), array('i'))
+            rows, counts = self.postings[word]
+            rows.append(row)
+            counts.append(count)
+        self.lengths.append(len(words))
+        self.total_length += len(words)
+
+    def add(self, text):
+        self._add(text)
+        self.unsaved += 1
+        if self.unsaved >= max(self.save_every, self.n_rows // 10):
+            self.save()
+
+    def scores(self, text):
+        scores = np.zeros(self.n_rows, dtype=np.float32)
+        if self.n_rows == 0:
+            return scores
+        lengths = np.frombuffer(self.lengths, dtype=np.int32)
+        average_length = max(self.total_length / self.n_rows, 1)
+        for word in set(self.tokenize(text)):
+            if word not in self.postings:
+                continue
+            rows, counts = self.postings[word]
+            rows = np.frombuffer(rows, dtype=np.int32)
+            counts = np.frombuffer(counts, dtype=np.int32).astype(np.float32)
+            idf = math.log(1 + (self.n_rows - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths[rows] / average_length)
+            # rows are unique within one word's postings, so += adds once per row
+            scores[rows] += idf * counts * (self.k1 + 1) / (counts + norm)
+        return scores
+
+    def save(self):
+        words = list(self.postings.keys())
+        rows = [np.frombuffer(self.postings[word][0], dtype=np.int32) for word in words]
+        counts = [np.frombuffer(self.postings[word][1], dtype=np.int32) for word in words]
+        # written next to the old one and swapped in, so a crash while saving leaves the old one
+        tmp_path = f'{self.path[:-len(".npz")]}.tmp.npz'
+        np.savez(
+            tmp_path,
+            n_rows=np.array(self.n_rows),
+            lengths=np.frombuffer(self.lengths, dtype=np.int32),
+            words=np.array(words, dtype=str),
+            df=np.array([len(r) for r in rows], dtype=np.int64),
+            rows=np.concatenate(rows) if rows != [] else np.zeros(0, dtype=np.int32),
+            counts=np.concatenate(counts) if counts != [] else np.zeros(0, dtype=np.int32),
+        )
+        os.replace(tmp_path, self.path)
+        self.unsaved = 0
+
+
+def recall_report(exact_search, approx_search, queries, settings, n=10):
+    """Measures recall@n and latency of an approximate search against exact search.
+
+    exact_search(query, n) and approx_search(query, n, setting) both return (rows, scores).
+    queries are only passed on to them, so they can be vectors, or anything the two searches look vectors up by.
+    Returns a list of dicts, one per setting, and prints them as a table."""
+
+    exact_rows = []
+    t0 = time.time()
+    for query in queries:
+        exact_rows.append(set(exact_search(query, n)[0].tolist()))
+    exact_ms = 1000 * (time.time()-t0) / len(queries)
+
+    report = []
+    for setting in settings:
+        hits = 0
+        t0 = time.time()
+        for query, truth in zip(queries, exact_rows):
+            rows, _ = approx_search(query, n, setting)
+            hits += len(truth.intersection(rows.tolist()))
+        ms = 1000 * (time.time()-t0) / len(queries)
+        total = sum(len(truth) for truth in exact_rows)
+        report.append({
+            'setting': setting,
+            'recall': hits/total if total else 1.0,
+            'ms per query': ms,
+            'exact ms per query': exact_ms,
+        })
+
+    print(f'recall@{n} over {len(queries)} queries, exact search takes {exact_ms:.3f} ms per query')
+    for item in report:
+        print(f"    {item['setting']}: recall {item['recall']:.3f}, {item['ms per query']:.3f} ms per query")
+    return report
@@ -0,0 +1,229 @@
+"""
+Tests of the DataHandler store on disk: vacuum, the mutation log, recovery of an unfinished store, and the sqlite import.
+
+Offline, vectors come from benchmark.RandomProvider. Every test runs in its own temporary folder,
+as DataHandler keeps its files in the working directory.
+
+    python -m pytest test_embeddings_module.py
+"""
+
+import os
+import numpy as np
+import pytest
+
+import embeddings_module
+from benchmark import RandomProvider, random_unit_vectors
+
+dim = 16
+
+@pytest.fixture(autouse=True)
+def in_tmp_folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+def open_handler(**kwargs):
+    return embeddings_module.DataHandler(provider=RandomProvider(dim), search_workers=1, **kwargs)
+
+def close(data_handler):
+    data_handler.metadata.close()
+
+def fill(data_handler, n_rows, seed=0):
+    """Stores n_rows rows 'text i' with tags ['even'] or ['odd'], returns their vectors."""
+    vectors = random_unit_vectors(np.random.default_rng(seed), n_rows, dim)
+    texts = [f'text {i}' for i in range(n_rows)]
+    metas = [['even' if i % 2 == 0 else 'odd'] for i in range(n_rows)]
+    data_handler._store_embeddings(texts, vectors, metas)
+    return vectors
+
+def top_text(data_handler, vector, has=()):
+    return data_handler.search(vector, {'n': 1, 'has': list(has), 'hasno': []})[0]['text']
+
+def assert_rows(data_handler, vectors, deleted=()):
+    # every row that is left has its own text, tags and vector, and is found by searching for its vector
+    live = [i for i in range(len(vectors)) if i not in deleted]
+    assert sorted(data_handler.row_to_string[row] for row in data_handler.hash_to_row.values()) == sorted(f'text {i}' for i in live)
+    for i in live:
+        row = data_handler.hash_to_row[embeddings_module.content_hash(f'text {i}')]
+        assert np.array_equal(data_handler.emb_array[row], vectors[i])
+        assert top_text(data_handler, vectors[i]) == f'text {i}'
+    assert data_handler.verify() == []
+
+def test_search_empty_store():
+    data_handler = open_handler()
+    query = random_unit_vectors(np.random.default_rng(0), 2, dim)
+    assert data_handler.search(query[0], {'n': 5, 'has': [], 'hasno': []}) == []
+    assert data_handler.search(query[0], {'n': 5, 'has': [], 'hasno': [], 'lexical_weight': 0.5, 'text': 'word'}) == []
+    assert data_handler.search_many(list(query), {'n': 5, 'has': [], 'hasno': []}) == [[], []]
+
+    # and the store works as usual afterwards
+    vectors = fill(data_handler, 3)
+    assert top_text(data_handler, vectors[2]) == 'text 2'
+    close(data_handler)
+
+def test_recall_reports_need_their_index():
+    data_handler = open_handler()
+    fill(data_handler, 20)
+    for report, message in [
+        (data_handler.ivf_recall_report, 'train_ivf'),
+        (data_handler.hnsw_recall_report, 'build_hnsw'),
+        (data_handler.pca_recall_report, 'fit_pca'),
+        (data_handler.hamming_recall_report, 'signatures=True'),
+    ]:
+        with pytest.raises(ValueError, match=message):
+            report()
+    close(data_handler)
+
+def test_vacuum_round_trip():
+    data_handler = open_handler(signatures=True)
+    vectors = fill(data_handler, 50)
+    deleted = set(range(0, 50, 5))
+    assert data_handler.delete_embeddings([f'text {i}' for i in deleted]) == len(deleted)
+    data_handler.set_tags('text 1', ['retagged'])
+
+    data_handler.vacuum()
+    assert len(data_handler.segment) == len(data_handler.metadata) == 40
+    assert data_handler.tombstones.n_set == 0
+    assert [name for name in os.listdir() if '.vacuum' in name] == []
+    assert_rows(data_handler, vectors, deleted)
+    assert top_text(data_handler, vectors[1], has=['retagged']) == 'text 1'
+    close(data_handler)
+
+    data_handler = open_handler(signatures=True)
+    assert len(data_handler.row_to_string) == 40
+    assert_rows(data_handler, vectors, deleted)
+    assert data_handler.get_tags().count('retagged') == 1
+    close(data_handler)
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/maps'), reason='needs /proc/self/maps')
+def test_vacuum_releases_old_segment(monkeypatch):
+    # windows can't replace a mapped file, so nothing may map the old segment when it is swapped.
+    # linux allows it, so the test looks at the mappings at the moment of the swap
+    data_handler = open_handler(memory_mapped=True)
+    vectors = fill(data_handler, 50)
+    data_handler.build_hnsw()
+    data_handler.delete_embeddings([f'text {i}' for i in range(10)])
+
+    mapped_at_swap = []
+    replace = os.replace
+    def checked_replace(src, dst):
+        if dst == data_handler.segment_path:
+            with open('/proc/self/maps') as f:
+                mapped_at_swap.extend(line for line in f if line.rstrip().endswith(os.path.abspath(dst)))
+        replace(src, dst)
+    monkeypatch.setattr(os, 'replace', checked_replace)
+
+    data_handler.vacuum()
+    assert len(data_handler.segment) == 40
+    assert mapped_at_swap == []
+    assert_rows(data_handler, vectors, deleted=set(range(10)))
+    close(data_handler)
+
+def test_log_replay_after_unclean_stop():
+    data_handler = open_handler()
+    vectors = fill(data_handler, 20)
+    data_handler.delete_embedding('text 3')
+    data_handler.set_tags('text 4', ['retagged'])
+    # stopped without compact_log(), so the changes are only in the log
+    assert len(data_handler.log) == 2
+    close(data_handler)
+
+    data_handler = open_handler()
+    assert_rows(data_handler, vectors, deleted={3})
+    assert data_handler.tombstones.n_set == 1
+    assert data_handler.row_meta[data_handler.hash_to_row[embeddings_module.content_hash('text 4')]] == ['retagged']
+    assert top_text(data_handler, vectors[4], has=['retagged']) == 'text 4'
+    assert data_handler._filter_mask(['even'], []).sum() == 9  # text 4 isn't 'even' anymore, text 3 was 'odd'
+    close(data_handler)
+
+def test_log_replay_onto_saved_tag_index():
+    data_handler = open_handler()
+    fill(data_handler, 20)
+    data_handler.set_tags('text 4', ['retagged'])
+    data_handler.set_tags('text 4', ['odd', 'again'])
+    # the tag index was saved after the retags, the metadata store wasn't
+    data_handler.tag_index.save()
+    close(data_handler)
+
+    data_handler = open_handler()
+    assert data_handler._filter_mask(['even'], []).sum() == 9
+    assert data_handler._filter_mask(['odd'], []).sum() == 11
+    assert data_handler._filter_mask(['again'], []).nonzero()[0].tolist() == [4]
+    assert data_handler._filter_mask(['retagged'], []).sum() == 0
+    close(data_handler)
+
+def test_torn_row_file_is_recovered():
+    data_handler = open_handler()
+    vectors = fill(data_handler, 10)
+    close(data_handler)
+
+    # a crash in the middle of _store_embeddings: the metadata of 3 rows is written, the vectors of one and a half
+    data_handler = open_handler()
+    data_handler.metadata.append_many(
+        [embeddings_module.content_hash(f'lost {i}') for i in range(3)],
+        [f'lost {i}' for i in range(3)],
+        [['lost']] * 3,
+        [data_handler.provider.name] * 3,
+    )
+    lost = random_unit_vectors(np.random.default_rng(1), 2, dim)
+    with open(data_handler.segment_path, 'ab') as f:
+        f.write(lost.tobytes()[:dim * 4 * 3 // 2])
+    close(data_handler)
+
+    # the half row is cut off, and the rows are cut back to the 11 that are in both files
+    data_handler = open_handler()
+    assert len(data_handler.segment) == len(data_handler.metadata) == len(data_handler.row_to_string) == 11
+    assert os.path.getsize(data_handler.segment_path) == data_handler.segment.row_offset + 11 * dim * 4
+    assert data_handler.row_to_string[10] == 'lost 0'
+    assert np.array_equal(data_handler.emb_array[10], lost[0])
+    assert data_handler._find_embedding('lost 1') == ('fail', None)
+    assert data_handler.verify() == []
+
+    # the next store appends at the row boundary again
+    more = random_unit_vectors(np.random.default_rng(2), 2, dim)
+    data_handler._store_embeddings(['more 0', 'more 1'], more, [['more'], ['more']])
+    close(data_handler)
+    data_handler = open_handler()
+    assert len(data_handler.row_to_string) == 13
+    assert top_text(data_handler, more[1]) == 'more 1'
+    for i in range(10):
+        assert top_text(data_handler, vectors[i]) == f'text {i}'
+    assert data_handler.verify() == []
+    close(data_handler)
+
+def test_import_of_first_version_json_files():
+    # string_to_info.json, with one json file per vector in embeddings/, like the first version stored them
+    from overall_imports import make_json
+    vectors = random_unit_vectors(np.random.default_rng(0), 5, 1536)
+    os.mkdir('embeddings')
+    string_to_info = {}
+    for i, vector in enumerate(vectors):
+        make_json(vector.tolist(), f'embeddings/{i}.json')
+        string_to_info[f'text {i}'] = {'path': f'embeddings/{i}.json', 'meta': [f'tag {i}']}
+    make_json(string_to_info, 'string_to_info.json')
+
+    # the default provider, the json files were embedded by the api
+    data_handler = embeddings_module.DataHandler(search_workers=1)
+    assert data_handler.row_to_string == [f'text {i}' for i in range(5)]
+    assert data_handler.row_meta == [[f'tag {i}'] for i in range(5)]
+    assert np.allclose(data_handler.emb_array, vectors)
+    assert data_handler.search(vectors[3], {'n': 1, 'has': [], 'hasno': []})[0]['text'] == 'text 3'
+    close(data_handler)
+
+def test_sqlite_imports_files_store():
+    data_handler = open_handler()
+    vectors = fill(data_handler, 30)
+    data_handler.delete_embedding('text 7')
+    data_handler.compact_log()
+    digests, texts, metas, providers = data_handler.metadata.read_all()
+    close(data_handler)
+
+    data_handler = open_handler(metadata='sqlite')
+    assert data_handler.metadata.read_all() == (digests, texts, metas, providers)
+    assert_rows(data_handler, vectors, deleted={7})
+    assert sorted(data_handler.get_tags()) == ['even', 'odd']
+    assert data_handler._filter_mask(['odd'], []).sum() == 14
+    close(data_handler)
+
+    # imported once, opening it again doesn't import a second time
+    data_handler = open_handler(metadata='sqlite')
+    assert len(data_handler.metadata) == 30
+    close(data_handler)
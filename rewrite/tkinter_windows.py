@@ -320,11 +320,13 @@ class EmbeddingsWindow(tk.Toplevel):
             'n': 3,
             'hasno': ['search terms', 'search term'],
             'has': [],
+            'lexical_weight': 0.0,  # 0 is embeddings only, 1 is keywords (bm25) only
         }
         for k,v in defaults.items():
             if k not in search_params:
                 search_params[k] = v
         search_params['n'] = int(search_params['n'])
+        search_params['lexical_weight'] = float(search_params['lexical_weight'])
 
         return search_params
 
@@ -346,8 +348,13 @@ class EmbeddingsWindow(tk.Toplevel):
                     lines.append('-'*10)
                 return '\n'.join(lines)
 
-            res = self.data_handler.search(
-                self.data_handler.get_embedding(searchterm),
+            if search_params.get('lexical_weight', 0) > 0 or search_params.get('prefilter') == 'bm25':
+                # the keyword side needs the words of the search term, not just its embedding
+                search_params['text'] = searchterm
+
+            # search_batched, because this runs on its own thread and may overlap with other searches
+            res = self.data_handler.search_batched(
+                self.data_handler.get_query_embedding(searchterm),
                 search_params,
             )
 
@@ -378,8 +385,10 @@ class EmbeddingsWindow(tk.Toplevel):
                 return '\n'.join(lines)
 
             # embed search term and do search
-            res = self.data_handler.search(
-                self.data_handler.get_embedding(searchterm),
+            if search_params.get('lexical_weight', 0) > 0 or search_params.get('prefilter') == 'bm25':
+                search_params['text'] = searchterm
+            res = self.data_handler.search_batched(
+                self.data_handler.get_query_embedding(searchterm),
                 search_params,
             )
 